@@ -1,9 +1,26 @@
-﻿import json
+﻿import copy
+import base64
+import hashlib
+import hmac
+import json
+import math
+import mimetypes
 import os
+import queue
+import io
+import re
+import shutil
 import sqlite3
+import subprocess
+import threading
+import time
 import uuid
-from datetime import datetime
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import parse_qs
 
 from flask import (
     Flask,
@@ -11,40 +28,363 @@ from flask import (
     redirect,
     render_template,
     request,
+    send_from_directory,
     session,
     url_for,
 )
 from flask_socketio import SocketIO, emit, join_room
-from werkzeug.security import check_password_hash, generate_password_hash
+from socketio import PubSubManager
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
+from password_hashing import HasherBusy, PasswordHasher
+
+try:
+    import msgpack
+except ImportError:  # optional: without it every socket gets the JSON wire format
+    msgpack = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # previews are skipped; the timeline falls back to the original files
+    Image = ImageOps = None
+
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / "database.db"
 UPLOAD_DIR = BASE_DIR / "static" / "uploads"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# Partial resumable uploads live outside static/ so nothing half-written is ever served.
+UPLOAD_TMP_DIR = BASE_DIR / "upload_tmp"
+UPLOAD_TMP_DIR.mkdir(parents=True, exist_ok=True)
+# Content-addressed blobs: static/uploads/cas/ab/cd/<sha256>.<ext>, shared by every message/avatar that uses them.
+MEDIA_STORE_DIR = UPLOAD_DIR / "cas"
+MEDIA_URL_RE = re.compile(r"^/media/cas/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$")
 
 ALLOWED_IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 ALLOWED_VIDEO_EXTENSIONS = {"mp4", "webm", "mov", "m4v", "ogg"}
 ALLOWED_DOCUMENT_EXTENSIONS = {"pdf", "doc", "docx", "ppt", "pptx", "xls", "xlsx", "txt", "zip", "rar", "csv"}
 ALLOWED_AUDIO_EXTENSIONS = {"webm", "wav", "mp3", "m4a", "aac", "ogg"}
 MAX_UPLOAD_MB = 25
+MAX_RESUMABLE_UPLOAD_MB = int(os.environ.get("MAX_RESUMABLE_UPLOAD_MB", 200))
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+UPLOAD_TTL_HOURS = 24
+MEDIA_GC_GRACE_HOURS = int(os.environ.get("MEDIA_GC_GRACE_HOURS", 24))
+PREVIEW_MAX_PX = 320
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", 2))
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN") or shutil.which("ffmpeg")
+# Internal nginx location aliased to static/uploads; when set, /media responses carry X-Accel-Redirect instead of bytes.
+MEDIA_ACCEL_REDIRECT = os.environ.get("MEDIA_ACCEL_REDIRECT", "").rstrip("/")
+# Signed /media links expire on a window boundary one to two windows out, so a URL stays byte-identical (and
+# browser-cacheable) for a whole window.
+MEDIA_URL_TTL_SEC = int(os.environ.get("MEDIA_URL_TTL_SEC", 12 * 3600))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_STATEMENT_CACHE_SIZE = 256
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SEC = int(os.environ.get("USER_CACHE_TTL_SEC", 300))
+MESSAGE_BATCH_MAX = int(os.environ.get("MESSAGE_BATCH_MAX", 128))
+MESSAGE_BATCH_WAIT_MS = int(os.environ.get("MESSAGE_BATCH_WAIT_MS", 2))
+BULK_ACTION_MAX = 100
+WAVEFORM_MAX_SAMPLES = 80
+PRESENCE_BATCH_MS = int(os.environ.get("PRESENCE_BATCH_MS", 500))
+PRESENCE_GRACE_MS = int(os.environ.get("PRESENCE_GRACE_MS", 5000))
+READ_RECEIPT_FLUSH_MS = int(os.environ.get("READ_RECEIPT_FLUSH_MS", 250))
+PRESENCE_BACKEND = os.environ.get("PRESENCE_BACKEND", "memory").strip().lower()
+# Any werkzeug method string; the work factor rides along, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:1000000".
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 16))
+# "sqlite" relays emits between workers through the app database; any python-socketio client manager URL
+# (redis://, amqp://, ...) works too but needs that broker and its client package.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
+SOCKETIO_SQLITE_POLL_MS = int(os.environ.get("SOCKETIO_SQLITE_POLL_MS", 50))
+SOCKETIO_SQLITE_KEEP_SEC = 60
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-change-me")
 app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
-online_users = set()
-user_sockets = {}
-sid_to_user = {}
 
+class SQLiteQueueManager(PubSubManager):
+    """Broker-free Socket.IO message queue: workers append emits to socketio_events and tail the table."""
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    name = "sqlite"
+
+    def __init__(self, poll_sec, keep_sec):
+        super().__init__(channel="socketio")
+        self.poll_sec = poll_sec
+        self.keep_sec = keep_sec
+        self.publish_lock = threading.Lock()
+        self.publish_conn = None
+        self.published = 0
+
+    def _publish(self, data):
+        with self.publish_lock:
+            if self.publish_conn is None:
+                self.publish_conn = open_db()
+            conn = self.publish_conn
+            conn.execute(
+                "INSERT INTO socketio_events (payload, created_at) VALUES (?, ?)", (self.json.dumps(data), time.time())
+            )
+            self.published += 1
+            if self.published % 500 == 0:
+                conn.execute("DELETE FROM socketio_events WHERE created_at < ?", (time.time() - self.keep_sec,))
+            conn.commit()
+
+    def _listen(self):
+        conn = open_db(readonly=True)
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_events").fetchone()[0]
+        while True:
+            rows = conn.execute(
+                "SELECT id, payload FROM socketio_events WHERE id > ? ORDER BY id LIMIT 500", (last_id,)
+            ).fetchall()
+            for row in rows:
+                last_id = row["id"]
+                yield row["payload"]
+            if not rows:
+                time.sleep(self.poll_sec)
+
+
+if SOCKETIO_MESSAGE_QUEUE == "sqlite":
+    socketio = SocketIO(
+        app,
+        cors_allowed_origins="*",
+        async_mode="threading",
+        client_manager=SQLiteQueueManager(SOCKETIO_SQLITE_POLL_MS / 1000, SOCKETIO_SQLITE_KEEP_SEC),
+    )
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading", message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connection borrowed from a ConnectionPool; close() hands it back once the borrowing thread's last user is done."""
+
+    pool = None
+    depth = 0
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        elif self.depth > 1:
+            self.depth -= 1
+        elif self.depth == 1:
+            self.release()
+
+    def release(self):
+        if not self.depth:
+            return
+        self.depth = 0
+        if self.in_transaction:
+            self.rollback()
+        self.pool.give_back(self)
+
+
+class ConnectionPool:
+    """Idle connections shared by every thread (Socket.IO runs each event on a fresh one).
+
+    A thread keeps the connection it borrowed for nested get_db() calls; at most `size` idle connections are kept.
+    """
+
+    def __init__(self, readonly, size):
+        self.readonly = readonly
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.borrowed = threading.local()
+        self.opened = 0
+
+    def borrow(self):
+        conn = getattr(self.borrowed, "conn", None)
+        if conn is None:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = open_db(self.readonly)
+                conn.pool = self
+                self.opened += 1
+            self.borrowed.conn = conn
+        conn.depth += 1
+        return conn
+
+    def give_back(self, conn):
+        if getattr(self.borrowed, "conn", None) is conn:
+            self.borrowed.conn = None
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            sqlite3.Connection.close(conn)
+
+    def release(self):
+        conn = getattr(self.borrowed, "conn", None)
+        if conn is not None:
+            conn.release()
+
+    def stats(self):
+        return {"opened": self.opened, "idle": self.idle.qsize()}
+
+
+def open_db(readonly=False):
+    if readonly:
+        conn = sqlite3.connect(
+            f"{DB_PATH.as_uri()}?mode=ro",
+            uri=True,
+            factory=PooledConnection,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            check_same_thread=False,
+        )
+    else:
+        conn = sqlite3.connect(
+            DB_PATH, factory=PooledConnection, cached_statements=DB_STATEMENT_CACHE_SIZE, check_same_thread=False
+        )
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    if not readonly:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
     return conn
 
 
+write_pool = ConnectionPool(readonly=False, size=DB_POOL_SIZE)
+read_pool = ConnectionPool(readonly=True, size=DB_POOL_SIZE)
+
+
+def get_db():
+    return write_pool.borrow()
+
+
+def get_read_db():
+    """Read-only connection for pure reads; under WAL it never waits on, or holds up, the writer."""
+    return read_pool.borrow()
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    write_pool.release()
+    read_pool.release()
+
+
+class MemoryPresenceRegistry:
+    """Socket registry private to one worker process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_sockets = {}
+        self.sid_to_user = {}
+
+    def purge_stale(self, conn):
+        pass
+
+    def add(self, sid, user_id):
+        with self.lock:
+            self.sid_to_user[sid] = user_id
+            sockets = self.user_sockets.setdefault(user_id, set())
+            sockets.add(sid)
+            return len(sockets)
+
+    def remove(self, sid):
+        """Forget sid and return (user_id, sockets that user still has open)."""
+        with self.lock:
+            user_id = self.sid_to_user.pop(sid, None)
+            if user_id is None:
+                return None, 0
+            sockets = self.user_sockets.get(user_id, set())
+            sockets.discard(sid)
+            if not sockets:
+                self.user_sockets.pop(user_id, None)
+            return user_id, len(sockets)
+
+    def device_count(self, user_id):
+        with self.lock:
+            return len(self.user_sockets.get(int(user_id), ()))
+
+    def device_counts(self, user_ids):
+        with self.lock:
+            return {int(u): len(self.user_sockets.get(int(u), ())) for u in user_ids}
+
+    def is_online(self, user_id):
+        return self.device_count(user_id) > 0
+
+
+class SQLitePresenceRegistry:
+    """Socket registry shared by all worker processes on the host through the presence_sockets table."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+
+    def purge_stale(self, conn):
+        for row in conn.execute("SELECT DISTINCT worker_pid FROM presence_sockets").fetchall():
+            pid = row["worker_pid"]
+            if pid == self.pid or not pid_alive(pid):
+                conn.execute("DELETE FROM presence_sockets WHERE worker_pid = ?", (pid,))
+
+    def add(self, sid, user_id):
+        conn = get_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO presence_sockets (sid, user_id, worker_pid, connected_at) VALUES (?, ?, ?, ?)",
+            (sid, user_id, self.pid, now_iso()),
+        )
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM presence_sockets WHERE user_id = ?", (user_id,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def remove(self, sid):
+        conn = get_db()
+        row = conn.execute("SELECT user_id FROM presence_sockets WHERE sid = ?", (sid,)).fetchone()
+        if not row:
+            conn.close()
+            return None, 0
+        conn.execute("DELETE FROM presence_sockets WHERE sid = ?", (sid,))
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM presence_sockets WHERE user_id = ?", (row["user_id"],)).fetchone()[0]
+        conn.close()
+        return row["user_id"], count
+
+    def device_count(self, user_id):
+        return self.device_counts([user_id])[int(user_id)]
+
+    def device_counts(self, user_ids):
+        counts = {int(u): 0 for u in user_ids}
+        if not counts:
+            return counts
+        conn = get_db()
+        placeholders = ",".join(["?"] * len(counts))
+        rows = conn.execute(
+            f"""
+            SELECT user_id, COUNT(*) AS sockets
+            FROM presence_sockets
+            WHERE user_id IN ({placeholders})
+            GROUP BY user_id
+            """,
+            list(counts),
+        ).fetchall()
+        conn.close()
+        for row in rows:
+            counts[row["user_id"]] = row["sockets"]
+        return counts
+
+    def is_online(self, user_id):
+        return self.device_count(user_id) > 0
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+presence = SQLitePresenceRegistry() if PRESENCE_BACKEND == "sqlite" else MemoryPresenceRegistry()
+
+
+def conversation_key(user_a, user_b):
+    """Canonical id shared by both directions of a one-to-one conversation."""
+    low, high = sorted((int(user_a), int(user_b)))
+    return f"{low}_{high}"
+
+
 def now_iso():
     return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
@@ -68,22 +408,244 @@ def classify_media(filename, preferred_type=None):
     return None
 
 
+class LRUCache:
+    """In-process LRU of loader(key) results.
+
+    Writers call invalidate(); the TTL only bounds staleness for changes made by other worker processes.
+    """
+
+    def __init__(self, loader, max_size, ttl_sec):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        key = int(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy.copy(entry[1])
+            self.misses += 1
+            generation = self.generation
+
+        value = self.loader(key)
+        if value is None:
+            return None
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.monotonic() + self.ttl_sec, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return copy.copy(value)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(int(key), None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def load_user(user_id):
+    conn = get_db()
+    row = conn.execute("SELECT id, username, email, avatar_url FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def load_friend_ids(user_id):
+    conn = get_db()
+    rows = conn.execute("SELECT friend_id FROM friends WHERE user_id = ?", (user_id,)).fetchall()
+    conn.close()
+    return frozenset(r["friend_id"] for r in rows)
+
+
+user_cache = LRUCache(load_user, USER_CACHE_SIZE, USER_CACHE_TTL_SEC)
+friends_cache = LRUCache(load_friend_ids, USER_CACHE_SIZE, USER_CACHE_TTL_SEC)
+
+
 def auth_user():
     user_id = session.get("user_id")
     if not user_id:
         return None
-    conn = get_db()
-    user = conn.execute(
-        "SELECT id, username, email, avatar_url FROM users WHERE id = ?", (user_id,)
-    ).fetchone()
-    conn.close()
-    return user
+    return user_cache.get(user_id)
+
+
+class PeriodicFlusher:
+    """Every interval_sec, a lazily started thread swaps out self.pending and hands it to flush(pending)."""
+
+    thread_name = "flusher"
+
+    def __init__(self, interval_sec, empty):
+        self.interval_sec = interval_sec
+        self.empty = empty
+        self.lock = threading.Lock()
+        self.pending = empty()
+        self.thread = None
+
+    def wake(self):
+        # Called with self.lock held, right after adding to self.pending.
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=self.thread_name, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval_sec)
+            with self.lock:
+                pending, self.pending = self.pending, self.empty()
+            if not pending:
+                continue
+            try:
+                self.flush(pending)
+            except Exception:
+                app.logger.exception("%s flush failed", self.thread_name)
+
+    def flush(self, pending):
+        raise NotImplementedError
+
+
+class PresenceAggregator(PeriodicFlusher):
+    """Settles touched users every batch_sec into one presence_batch frame per room, holding offlines for grace_sec."""
+
+    thread_name = "presence-aggregator"
+
+    def __init__(self, batch_sec, grace_sec):
+        super().__init__(batch_sec, set)
+        self.grace_sec = grace_sec
+        self.offline_since = {}
+        self.last_sent = {}
+
+    def notify(self, user_id, went_offline=False):
+        user_id = int(user_id)
+        with self.lock:
+            self.pending.add(user_id)
+            if went_offline:
+                self.offline_since.setdefault(user_id, (time.monotonic(), now_iso()))
+            else:
+                self.offline_since.pop(user_id, None)
+            self.wake()
+
+    def flush(self, user_ids):
+        counts = presence.device_counts(user_ids)
+        entries = []
+        last_seen_writes = []
+        now = time.monotonic()
+        with self.lock:
+            for user_id in user_ids:
+                device_count = counts[user_id]
+                last_seen = None
+                if not device_count:
+                    since = self.offline_since.get(user_id)
+                    if since and now - since[0] < self.grace_sec:
+                        self.pending.add(user_id)
+                        continue
+                    self.offline_since.pop(user_id, None)
+                    last_seen = since[1] if since else now_iso()
+                    last_seen_writes.append((last_seen, user_id))
+                else:
+                    self.offline_since.pop(user_id, None)
+
+                state = (device_count > 0, device_count)
+                if self.last_sent.get(user_id) == state:
+                    continue
+                self.last_sent[user_id] = state
+                entries.append(
+                    {
+                        "user_id": user_id,
+                        "status": "online" if device_count else "offline",
+                        "is_online": bool(device_count),
+                        "device_count": device_count,
+                        "last_seen": last_seen,
+                    }
+                )
+
+        if last_seen_writes:
+            conn = get_db()
+            conn.executemany("UPDATE users SET last_seen = ? WHERE id = ?", last_seen_writes)
+            # last_seen is part of the contact row, so friends' delta cursors and ETags must move with it.
+            for _, user_id in last_seen_writes:
+                for friend_id in friends_cache.get(user_id) or ():
+                    touch_conversation(conn, friend_id, user_id)
+            conn.commit()
+            conn.close()
+
+        frames = {}
+        for entry in entries:
+            user_id = entry["user_id"]
+            for recipient_id in (user_id, *(friends_cache.get(user_id) or ())):
+                frames.setdefault(recipient_id, []).append(entry)
+        for recipient_id, batch in frames.items():
+            emit_to_users("presence_batch", {"presence": batch}, [recipient_id])
+
+
+presence_aggregator = PresenceAggregator(PRESENCE_BATCH_MS / 1000, PRESENCE_GRACE_MS / 1000)
+
+
+def pack_waveform(samples):
+    """Quantize waveform bar heights to one unsigned byte each; None when there is nothing to store."""
+    if not isinstance(samples, list):
+        return None
+    out = bytearray()
+    for value in samples[:WAVEFORM_MAX_SAMPLES]:
+        try:
+            out.append(max(0, min(255, round(float(value)))))
+        except (TypeError, ValueError):
+            continue
+    return bytes(out) or None
+
+
+def migrate_waveforms(conn):
+    """Move legacy waveform_json text into the packed waveform column and clear the text copy."""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(messages)").fetchall()}
+    if "waveform_json" not in columns:
+        return
+    rows = conn.execute("SELECT id, waveform_json FROM messages WHERE waveform_json IS NOT NULL").fetchall()
+    updates = []
+    for row in rows:
+        try:
+            samples = json.loads(row["waveform_json"])
+        except json.JSONDecodeError:
+            samples = None
+        updates.append((pack_waveform(samples), row["id"]))
+    conn.executemany("UPDATE messages SET waveform = ?, waveform_json = NULL WHERE id = ?", updates)
+
+
+def migrate_media_urls(conn):
+    """Point stored /static/uploads/... URLs at the /media route (a no-op once every row is rewritten)."""
+    for table, column in (("messages", "media_url"), ("messages", "image_url"), ("users", "avatar_url")):
+        conn.execute(
+            f"UPDATE {table} SET {column} = '/media/' || substr({column}, 17) WHERE {column} LIKE '/static/uploads/%'"
+        )
 
 
 def ensure_column(conn, table, column, ddl):
+    """Add a missing column; returns True if it had to be added."""
     columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
     if column not in columns:
         conn.execute(ddl)
+        return True
+    return False
 
 
 def init_db():
@@ -92,6 +654,10 @@ def init_db():
         conn.executescript(f.read())
 
     ensure_column(conn, "users", "last_seen", "ALTER TABLE users ADD COLUMN last_seen TEXT")
+    ensure_column(conn, "users", "username_lc", "ALTER TABLE users ADD COLUMN username_lc TEXT")
+    rows = conn.execute("SELECT id, username FROM users WHERE username_lc IS NULL").fetchall()
+    conn.executemany("UPDATE users SET username_lc = ? WHERE id = ?", [(r["username"].lower(), r["id"]) for r in rows])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lc ON users (username_lc, id)")
     ensure_column(conn, "messages", "reply_to_id", "ALTER TABLE messages ADD COLUMN reply_to_id INTEGER")
     ensure_column(conn, "messages", "forwarded_from_id", "ALTER TABLE messages ADD COLUMN forwarded_from_id INTEGER")
     ensure_column(conn, "messages", "edited_at", "ALTER TABLE messages ADD COLUMN edited_at TEXT")
@@ -100,17 +666,435 @@ def init_db():
     ensure_column(conn, "messages", "file_name", "ALTER TABLE messages ADD COLUMN file_name TEXT")
     ensure_column(conn, "messages", "file_size", "ALTER TABLE messages ADD COLUMN file_size INTEGER")
     ensure_column(conn, "messages", "duration_sec", "ALTER TABLE messages ADD COLUMN duration_sec REAL")
-    ensure_column(conn, "messages", "waveform_json", "ALTER TABLE messages ADD COLUMN waveform_json TEXT")
+    ensure_column(conn, "messages", "waveform", "ALTER TABLE messages ADD COLUMN waveform BLOB")
+    migrate_waveforms(conn)
+    ensure_column(
+        conn, "conversations", "change_id", "ALTER TABLE conversations ADD COLUMN change_id INTEGER NOT NULL DEFAULT 0"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_change ON conversations (user_id, change_id)")
+    ensure_column(conn, "messages", "conversation_id", "ALTER TABLE messages ADD COLUMN conversation_id TEXT")
+    conn.execute(
+        """
+        UPDATE messages
+        SET conversation_id = MIN(sender_id, recipient_id) || '_' || MAX(sender_id, recipient_id)
+        WHERE conversation_id IS NULL
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)")
+    watermarks_added = False
+    for column in ("last_incoming_id", "last_delivered_id", "last_read_id"):
+        watermarks_added |= ensure_column(
+            conn, "conversations", column, f"ALTER TABLE conversations ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"
+        )
+    # Delivery/read state lives in the conversation watermarks now; nothing looks messages up by status.
+    conn.execute("DROP INDEX IF EXISTS idx_messages_recipient_status")
+    if backfill_conversations(conn) or watermarks_added:
+        backfill_watermarks(conn)
+    migrate_media_urls(conn)
+    # build_preview looks up the conversations that already show a blob; both are mostly NULL, so keep them partial.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_media_url ON messages (media_url) WHERE media_url IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_image_url ON messages (image_url) WHERE image_url IS NOT NULL")
+    init_search_index(conn)
+    presence.purge_stale(conn)
 
     conn.commit()
+    collect_media(conn)
     conn.close()
 
 
+search_enabled = False
+user_trigram_enabled = False
+
+
+def create_fts_index(conn, name, columns):
+    """Create an external-content FTS5 table and build it from its source on first run; False if unsupported."""
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({columns})")
+    except sqlite3.OperationalError:
+        return False
+    if not existed:
+        conn.execute(f"INSERT INTO {name} ({name}) VALUES ('rebuild')")
+    return True
+
+
+def init_search_index(conn):
+    """Create the FTS5 indexes, or leave search on the slower paths if SQLite was built without FTS5/trigram."""
+    global search_enabled, user_trigram_enabled
+    search_enabled = create_fts_index(
+        conn,
+        "messages_fts",
+        "content, file_name, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'",
+    )
+    if not search_enabled:
+        app.logger.warning("SQLite FTS5 unavailable; message search disabled")
+    user_trigram_enabled = create_fts_index(
+        conn, "users_search", "username, email, content='users', content_rowid='id', tokenize='trigram'"
+    )
+
+
+def index_message(conn, message_id, content, file_name):
+    if search_enabled:
+        conn.execute(
+            "INSERT INTO messages_fts (rowid, content, file_name) VALUES (?, ?, ?)",
+            (message_id, content, file_name),
+        )
+
+
+def unindex_message(conn, message_id, content, file_name):
+    """Drop a row from the external-content index; content/file_name must be the values it was indexed with."""
+    if search_enabled:
+        conn.execute(
+            "INSERT INTO messages_fts (messages_fts, rowid, content, file_name) VALUES ('delete', ?, ?, ?)",
+            (message_id, content, file_name),
+        )
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query that ANDs each word as a prefix term, with no user-controlled syntax."""
+    terms = re.findall(r"\w+", text)[:8]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
 def can_access_pair(conn, me, peer_id):
     row = conn.execute("SELECT id FROM users WHERE id = ?", (peer_id,)).fetchone()
     return bool(row and int(me) != int(peer_id))
 
 
+def next_change_id(conn):
+    """Allocate the next contacts-sync cursor value inside the caller's transaction."""
+    conn.execute(
+        """
+        INSERT INTO sync_counters (name, value) VALUES ('contacts', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+        """
+    )
+    return conn.execute("SELECT value FROM sync_counters WHERE name = 'contacts'").fetchone()[0]
+
+
+def refresh_conversation(conn, user_id, peer_id):
+    """Recompute the (user_id, peer_id) summary row from the messages table."""
+    last = conn.execute(
+        """
+        SELECT m.id, COALESCE(m.content, m.file_name, '[media]') AS preview, m.created_at
+        FROM messages m
+        WHERE m.conversation_id = ?
+          AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
+        ORDER BY m.id DESC
+        LIMIT 1
+        """,
+        (conversation_key(user_id, peer_id), user_id),
+    ).fetchone()
+    unread = conn.execute(
+        """
+        SELECT COUNT(*)
+        FROM messages m
+        WHERE m.conversation_id = ? AND m.sender_id = ? AND m.deleted_at IS NULL
+          AND m.id > COALESCE((SELECT last_read_id FROM conversations WHERE user_id = ? AND peer_id = ?), 0)
+          AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
+        """,
+        (conversation_key(user_id, peer_id), peer_id, user_id, peer_id, user_id),
+    ).fetchone()[0]
+
+    conn.execute(
+        """
+        INSERT INTO conversations (
+          user_id, peer_id, last_message_id, last_message, last_message_time, unread_count, change_id, updated_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, peer_id) DO UPDATE SET
+          last_message_id = excluded.last_message_id,
+          last_message = excluded.last_message,
+          last_message_time = excluded.last_message_time,
+          unread_count = excluded.unread_count,
+          change_id = excluded.change_id,
+          updated_at = excluded.updated_at
+        """,
+        (
+            user_id,
+            peer_id,
+            last["id"] if last else None,
+            last["preview"] if last else None,
+            last["created_at"] if last else None,
+            unread,
+            next_change_id(conn),
+            now_iso(),
+        ),
+    )
+
+
+def record_conversation_message(conn, sender_id, recipient_id, message_id, preview, created_at, delivered):
+    """Fold a freshly inserted message into both summary rows without rescanning history.
+
+    The recipient's row also advances its incoming watermark, and its delivered watermark when the
+    recipient had a socket open at send time.
+    """
+    delivered_id = message_id if delivered else 0
+    for user_id, peer_id, unread_delta, incoming_id, delivered_to in (
+        (sender_id, recipient_id, 0, 0, 0),
+        (recipient_id, sender_id, 1, message_id, delivered_id),
+    ):
+        conn.execute(
+            """
+            INSERT INTO conversations (
+              user_id, peer_id, last_message_id, last_message, last_message_time, unread_count, change_id, updated_at,
+              last_incoming_id, last_delivered_id
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, peer_id) DO UPDATE SET
+              last_message_id = excluded.last_message_id,
+              last_message = excluded.last_message,
+              last_message_time = excluded.last_message_time,
+              unread_count = conversations.unread_count + ?,
+              change_id = excluded.change_id,
+              updated_at = excluded.updated_at,
+              last_incoming_id = MAX(conversations.last_incoming_id, excluded.last_incoming_id),
+              last_delivered_id = MAX(conversations.last_delivered_id, excluded.last_delivered_id)
+            """,
+            (
+                user_id,
+                peer_id,
+                message_id,
+                preview,
+                created_at,
+                unread_delta,
+                next_change_id(conn),
+                created_at,
+                incoming_id,
+                delivered_to,
+                unread_delta,
+            ),
+        )
+
+
+def mark_conversation_read(conn, user_id, peer_id, up_to=None):
+    """Move the read watermark up to up_to (default: the newest incoming message).
+
+    Returns the new watermark, or None if it did not move.
+    """
+    row = conn.execute(
+        "SELECT last_incoming_id, last_read_id FROM conversations WHERE user_id = ? AND peer_id = ?",
+        (user_id, peer_id),
+    ).fetchone()
+    if not row:
+        return None
+    read_id = min(row["last_incoming_id"], up_to) if up_to else row["last_incoming_id"]
+    if read_id <= row["last_read_id"]:
+        return None
+    unread = 0
+    if read_id < row["last_incoming_id"]:
+        unread = conn.execute(
+            """
+            SELECT COUNT(*)
+            FROM messages m
+            WHERE m.conversation_id = ? AND m.id > ? AND m.sender_id = ? AND m.deleted_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
+            """,
+            (conversation_key(user_id, peer_id), read_id, peer_id, user_id),
+        ).fetchone()[0]
+    conn.execute(
+        """
+        UPDATE conversations
+        SET last_read_id = ?, last_delivered_id = MAX(last_delivered_id, ?), unread_count = ?,
+            change_id = ?, updated_at = ?
+        WHERE user_id = ? AND peer_id = ?
+        """,
+        (read_id, read_id, unread, next_change_id(conn), now_iso(), user_id, peer_id),
+    )
+    return read_id
+
+
+def mark_conversation_delivered(conn, user_id):
+    """On connect, advance every delivered watermark of user_id's conversations; returns [(peer_id, up_to_id)]."""
+    rows = conn.execute(
+        """
+        SELECT peer_id, last_incoming_id
+        FROM conversations
+        WHERE user_id = ? AND last_incoming_id > last_delivered_id
+        """,
+        (user_id,),
+    ).fetchall()
+    if rows:
+        conn.execute(
+            "UPDATE conversations SET last_delivered_id = last_incoming_id WHERE user_id = ? AND last_incoming_id > last_delivered_id",
+            (user_id,),
+        )
+    return [(r["peer_id"], r["last_incoming_id"]) for r in rows]
+
+
+def emit_read_up_to(reader_id, sender_id, up_to, read):
+    """Tell sender_id's devices that every message they sent reader_id with id <= up_to is delivered (and read)."""
+    payload = {"peer_id": int(reader_id), "delivered_up_to": up_to}
+    if read:
+        payload["read_up_to"] = up_to
+    emit_to_users("read_up_to", payload, [sender_id])
+
+
+class ReadReceiptAggregator(PeriodicFlusher):
+    """Keeps the highest mark_read id per (reader, peer) and applies them every flush_sec in one transaction."""
+
+    thread_name = "read-receipts"
+
+    def __init__(self, flush_sec):
+        super().__init__(flush_sec, dict)
+
+    def mark(self, user_id, peer_id, up_to):
+        key = (int(user_id), int(peer_id))
+        with self.lock:
+            self.pending[key] = max(self.pending.get(key, 0), up_to)
+            self.wake()
+
+    def flush(self, pending):
+        conn = get_db()
+        moved = []
+        for (user_id, peer_id), up_to in pending.items():
+            read_id = mark_conversation_read(conn, user_id, peer_id, up_to)
+            if read_id:
+                moved.append((user_id, peer_id, read_id))
+        conn.commit()
+        push_contact_updates(conn, [(user_id, peer_id) for user_id, peer_id, _ in moved])
+        conn.close()
+        for user_id, peer_id, read_id in moved:
+            emit_read_up_to(user_id, peer_id, read_id, read=True)
+
+
+read_receipts = ReadReceiptAggregator(READ_RECEIPT_FLUSH_MS / 1000)
+
+
+def touch_conversation(conn, user_id, peer_id):
+    """Bump the sync cursor of a summary row whose contact fields changed elsewhere."""
+    conn.execute(
+        "UPDATE conversations SET change_id = ?, updated_at = ? WHERE user_id = ? AND peer_id = ?",
+        (next_change_id(conn), now_iso(), user_id, peer_id),
+    )
+
+
+CONTACTS_QUERY = """
+    SELECT u.id, u.username, u.email, u.avatar_url, u.last_seen,
+           c.last_message, c.last_message_time, COALESCE(c.unread_count, 0) AS unread_count,
+           COALESCE(c.last_message_time, u.created_at) AS sort_time,
+           COALESCE(c.change_id, 0) AS change_id
+    FROM friends f
+    JOIN users u ON u.id = f.friend_id
+    LEFT JOIN conversations c ON c.user_id = f.user_id AND c.peer_id = f.friend_id
+"""
+
+
+def contact_items(rows):
+    counts = presence.device_counts([row["id"] for row in rows])
+    items = []
+    for row in rows:
+        item = dict(row)
+        item["is_online"] = counts[row["id"]] > 0
+        item["device_count"] = counts[row["id"]]
+        item["avatar_url"] = sign_media_url(item["avatar_url"])
+        items.append(item)
+    return items
+
+
+def contacts_etag(conn, user_id):
+    """Validator for the full contact list: the user's newest change_id, a digest of friends' online state and
+    the signed-URL window (avatar links are re-signed when it rolls over)."""
+    change_id = conn.execute(
+        "SELECT COALESCE(MAX(change_id), 0) FROM conversations WHERE user_id = ?", (user_id,)
+    ).fetchone()[0]
+    counts = presence.device_counts(sorted(friends_cache.get(user_id) or ()))
+    online = ",".join(f"{friend_id}:{count}" for friend_id, count in sorted(counts.items()) if count)
+    return f"c{user_id}-{change_id}-{zlib.crc32(online.encode()):08x}-{media_url_window()}"
+
+
+def messages_etag(conn, user_id, peer_id):
+    """Validator for a conversation's history pages, from both summary rows' change_id and watermarks plus the
+    signed-URL window."""
+    rows = conn.execute(
+        """
+        SELECT user_id, change_id, last_delivered_id, last_read_id
+        FROM conversations
+        WHERE (user_id = ? AND peer_id = ?) OR (user_id = ? AND peer_id = ?)
+        ORDER BY user_id = ? DESC
+        """,
+        (user_id, peer_id, peer_id, user_id, user_id),
+    ).fetchall()
+    parts = "-".join(f"{r['change_id']}.{r['last_delivered_id']}.{r['last_read_id']}" for r in rows)
+    return f"m{user_id}-{peer_id}-{parts}-{media_url_window()}"
+
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def fetch_contact(conn, user_id, peer_id):
+    """Return the contact row user_id sees for peer_id, or a removal marker if they are no longer friends."""
+    row = conn.execute(f"{CONTACTS_QUERY} WHERE f.user_id = ? AND f.friend_id = ?", (user_id, peer_id)).fetchone()
+    if row:
+        return contact_items([row])[0]
+    change = conn.execute(
+        "SELECT change_id FROM conversations WHERE user_id = ? AND peer_id = ?", (user_id, peer_id)
+    ).fetchone()
+    return {"id": int(peer_id), "removed": True, "change_id": change["change_id"] if change else 0}
+
+
+def push_contact_updates(conn, pairs):
+    """Emit the current contact row for each (user_id, peer_id) pair to user_id's room."""
+    for user_id, peer_id in dict.fromkeys((int(u), int(p)) for u, p in pairs):
+        socketio.emit("contact_updated", fetch_contact(conn, user_id, peer_id), room=f"user_{user_id}")
+
+
+def backfill_conversations(conn):
+    if conn.execute("SELECT 1 FROM conversations LIMIT 1").fetchone():
+        return False
+    pairs = set()
+    for row in conn.execute("SELECT DISTINCT sender_id, recipient_id FROM messages").fetchall():
+        pairs.add((row["sender_id"], row["recipient_id"]))
+        pairs.add((row["recipient_id"], row["sender_id"]))
+    for row in conn.execute("SELECT user_id, friend_id FROM friends").fetchall():
+        pairs.add((row["user_id"], row["friend_id"]))
+    for user_id, peer_id in pairs:
+        refresh_conversation(conn, user_id, peer_id)
+    return True
+
+
+def backfill_watermarks(conn):
+    """Derive the watermarks from the per-row status column they replace, then recount unread against them."""
+    conn.execute(
+        """
+        UPDATE conversations
+        SET last_incoming_id = COALESCE((
+              SELECT MAX(m.id) FROM messages m
+              WHERE m.conversation_id = MIN(user_id, peer_id) || '_' || MAX(user_id, peer_id)
+                AND m.sender_id = conversations.peer_id
+            ), 0),
+            last_delivered_id = COALESCE((
+              SELECT MAX(m.id) FROM messages m
+              WHERE m.conversation_id = MIN(user_id, peer_id) || '_' || MAX(user_id, peer_id)
+                AND m.sender_id = conversations.peer_id AND m.status IN ('delivered', 'seen')
+            ), 0),
+            last_read_id = COALESCE((
+              SELECT MAX(m.id) FROM messages m
+              WHERE m.conversation_id = MIN(user_id, peer_id) || '_' || MAX(user_id, peer_id)
+                AND m.sender_id = conversations.peer_id AND m.status = 'seen'
+            ), 0)
+        """
+    )
+    conn.execute(
+        """
+        UPDATE conversations
+        SET unread_count = (
+          SELECT COUNT(*) FROM messages m
+          WHERE m.conversation_id = MIN(conversations.user_id, conversations.peer_id) || '_' || MAX(conversations.user_id, conversations.peer_id)
+            AND m.sender_id = conversations.peer_id AND m.id > conversations.last_read_id AND m.deleted_at IS NULL
+            AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = conversations.user_id)
+        )
+        """
+    )
+
+
+NO_PREVIEW = {"thumb_url": None, "width": None, "height": None, "blurhash": None}
+
+
 def serialize_messages(conn, rows, viewer_id):
     message_ids = [r["id"] for r in rows]
     reactions_map = {mid: [] for mid in message_ids}
@@ -136,6 +1120,7 @@ def serialize_messages(conn, rows, viewer_id):
                 }
             )
 
+    previews = load_previews(conn, [r["media_url"] or r["image_url"] for r in rows])
     out = []
     for row in rows:
         item = dict(row)
@@ -155,43 +1140,268 @@ def serialize_messages(conn, rows, viewer_id):
             item["media_type"] = "image"
             item["media_url"] = item["image_url"]
 
-        waveform = item.get("waveform_json")
-        if waveform:
-            try:
-                item["waveform"] = json.loads(waveform)
-            except json.JSONDecodeError:
-                item["waveform"] = []
-        else:
-            item["waveform"] = []
+        item["waveform"] = list(item["waveform"] or b"")
+        item.update(previews.get(item["media_url"]) or NO_PREVIEW)
+        sign_message_urls(item)
 
         out.append(item)
     return out
 
 
-def emit_message_status_bulk(conn, recipient_id, from_status, to_status):
-    rows = conn.execute(
-        "SELECT id, sender_id FROM messages WHERE recipient_id = ? AND status = ?",
-        (recipient_id, from_status),
-    ).fetchall()
-    if not rows:
-        return
-
-    ids = [r["id"] for r in rows]
-    conn.execute(
-        f"UPDATE messages SET status = ? WHERE id IN ({','.join(['?'] * len(ids))})",
-        [to_status, *ids],
+def insert_message(conn, record):
+    cur = conn.execute(
+        """
+        INSERT INTO messages (
+          sender_id, recipient_id, conversation_id, content, image_url, media_url, media_type, file_name,
+          file_size, duration_sec, waveform, reply_to_id, forwarded_from_id, status, created_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            record["sender_id"],
+            record["recipient_id"],
+            conversation_key(record["sender_id"], record["recipient_id"]),
+            record["content"],
+            record["image_url"],
+            record["media_url"],
+            record["media_type"],
+            record["file_name"],
+            record["file_size"],
+            record["duration_sec"],
+            record["waveform"],
+            record["reply_to_id"],
+            record["forwarded_from_id"],
+            record["status"],
+            record["created_at"],
+        ),
     )
-
-    by_sender = {}
-    for r in rows:
-        by_sender.setdefault(r["sender_id"], []).append(r["id"])
-
-    for sender_id, sender_ids in by_sender.items():
-        emit("message_status", {"message_ids": sender_ids, "status": to_status}, room=f"user_{sender_id}")
-
-
+    retain_media(conn, record["media_url"], record["image_url"])
+    record_conversation_message(
+        conn,
+        record["sender_id"],
+        record["recipient_id"],
+        cur.lastrowid,
+        record["content"],
+        record["created_at"],
+        record["status"] == "delivered",
+    )
+    index_message(conn, cur.lastrowid, record["content"], record["file_name"])
+    return cur.lastrowid
+
+
+class MessageWriter:
+    """Group-commits queued inserts on one thread; a second thread runs callback(conn, message_ids) after commit."""
+
+    def __init__(self, batch_max, batch_wait_sec):
+        self.batch_max = batch_max
+        self.batch_wait_sec = batch_wait_sec
+        self.queue = queue.Queue()
+        self.deliveries = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.batches = 0
+        self.messages = 0
+
+    def submit(self, records, callback):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="message-writer", daemon=True)
+                self.thread.start()
+                threading.Thread(target=self.deliver, name="message-delivery", daemon=True).start()
+        self.queue.put((records, callback))
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_wait_sec
+            while len(jobs) < self.batch_max:
+                try:
+                    jobs.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.write(jobs)
+            except Exception:
+                app.logger.exception("message batch failed, retrying jobs one by one")
+                for job in jobs:
+                    try:
+                        self.write([job])
+                    except Exception:
+                        app.logger.exception("dropping message job")
+
+    def write(self, jobs):
+        conn = get_db()
+        try:
+            results = [[insert_message(conn, record) for record in records] for records, _ in jobs]
+            conn.commit()
+        finally:
+            conn.close()
+
+        self.batches += 1
+        self.messages += sum(len(ids) for ids in results)
+        for (_, callback), message_ids in zip(jobs, results):
+            self.deliveries.put((callback, message_ids))
+
+    def deliver(self):
+        # Contact lookups and emits (a broker publish each, with a message queue) stay off the writer thread, so
+        # they never hold up the next batch; one thread keeps them in commit order.
+        while True:
+            callback, message_ids = self.deliveries.get()
+            conn = get_db()
+            try:
+                callback(conn, message_ids)
+            except Exception:
+                app.logger.exception("message callback failed")
+            finally:
+                conn.close()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "delivering": self.deliveries.qsize(),
+            "batches": self.batches,
+            "messages": self.messages,
+        }
+
+
+message_writer = MessageWriter(MESSAGE_BATCH_MAX, MESSAGE_BATCH_WAIT_MS / 1000)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+
+def build_message_payload(record, message_id, sender_name, reply_row=None):
+    """Assemble the new_message payload in the same shape serialize_messages gives a freshly inserted row."""
+    media_type = record["media_type"]
+    media_url = record["media_url"]
+    if not media_type and record["image_url"]:
+        media_type = "image"
+        media_url = record["image_url"]
+    return sign_message_urls({
+        "id": message_id,
+        "sender_id": record["sender_id"],
+        "recipient_id": record["recipient_id"],
+        "content": record["content"],
+        "image_url": record["image_url"],
+        "media_url": media_url,
+        "media_type": media_type,
+        "file_name": record["file_name"],
+        "file_size": record["file_size"],
+        "duration_sec": record["duration_sec"],
+        "waveform": list(record["waveform"] or b""),
+        "reply_to_id": record["reply_to_id"],
+        "forwarded_from_id": record["forwarded_from_id"],
+        "status": record["status"],
+        "created_at": record["created_at"],
+        "edited_at": None,
+        "deleted_at": None,
+        "sender_name": sender_name,
+        "reply_sender_name": reply_row["sender_name"] if reply_row else None,
+        "reply_content": reply_row["content"] if reply_row else None,
+        "reply_image_url": reply_row["image_url"] if reply_row else None,
+        **(record.get("preview") or NO_PREVIEW),
+        "reactions": [],
+        "is_forwarded": bool(record["forwarded_from_id"]),
+        "reply_preview": (
+            {
+                "id": record["reply_to_id"],
+                "sender_name": reply_row["sender_name"],
+                "content": reply_row["content"],
+                "image_url": reply_row["image_url"],
+            }
+            if reply_row
+            else None
+        ),
+    })
+
+
+# Short keys for the compact wire format. Fields the client can derive (is_forwarded, the reply_* copies) are
+# left out, the waveform travels as its raw bytes, and anything that is None is dropped.
+MESSAGE_WIRE_KEYS = {
+    "id": "i",
+    "sender_id": "s",
+    "recipient_id": "r",
+    "content": "c",
+    "image_url": "iu",
+    "media_url": "mu",
+    "media_type": "mt",
+    "file_name": "fn",
+    "file_size": "fs",
+    "duration_sec": "d",
+    "reply_to_id": "rt",
+    "forwarded_from_id": "f",
+    "status": "st",
+    "created_at": "t",
+    "edited_at": "e",
+    "deleted_at": "x",
+    "sender_name": "n",
+    "thumb_url": "tu",
+    "width": "pw",
+    "height": "ph",
+    "blurhash": "bh",
+}
+
+
+def compact_reactions(reactions):
+    return [[r["user_id"], r["username"], r["emoji"]] for r in reactions]
+
+
+def compact_message(message):
+    out = {short: message[key] for key, short in MESSAGE_WIRE_KEYS.items() if message.get(key) is not None}
+    if message.get("waveform"):
+        out["w"] = bytes(message["waveform"])
+    if message.get("reactions"):
+        out["rx"] = compact_reactions(message["reactions"])
+    preview = message.get("reply_preview")
+    if preview:
+        out["rp"] = {
+            short: preview[key]
+            for key, short in (("sender_name", "n"), ("content", "c"), ("image_url", "u"))
+            if preview[key]
+        }
+    return out
+
+
+WIRE_COMPACTORS = {
+    "new_message": compact_message,
+    "new_messages": lambda p: {"m": [compact_message(m) for m in p["messages"]]},
+    "read_up_to": lambda p: {
+        short: p[key] for key, short in (("peer_id", "p"), ("delivered_up_to", "d"), ("read_up_to", "r")) if key in p
+    },
+    "presence_batch": lambda p: {"p": [[e["user_id"], e["device_count"], e["last_seen"]] for e in p["presence"]]},
+    "message_reactions": lambda p: {"m": p["message_id"], "rx": compact_reactions(p["reactions"])},
+}
+
+
+def room_occupied(room):
+    """Whether any socket may be in room. Behind a message queue other workers' sockets are invisible: assume yes."""
+    if SOCKETIO_MESSAGE_QUEUE:
+        return True
+    return bool(socketio.server.manager.rooms.get("/", {}).get(room))
+
+
+def emit_to_users(event, payload, user_ids):
+    """Emit a chat event to every device of each user, in the wire format the device picked at connect.
+
+    JSON sockets sit in user_<id>_json, compact ones in user_<id>_bin. Empty rooms are skipped, and the MessagePack
+    body is packed at most once per event, only if some device takes it. With a message queue, room membership is
+    unknown locally, so both formats are published for each user (two queue writes per user instead of one).
+    """
+    packed = None
+    for user_id in dict.fromkeys(int(u) for u in user_ids):
+        if room_occupied(f"user_{user_id}_json"):
+            socketio.emit(event, payload, room=f"user_{user_id}_json")
+        if msgpack and room_occupied(f"user_{user_id}_bin"):
+            if packed is None:
+                packed = msgpack.packb(WIRE_COMPACTORS[event](payload))
+            socketio.emit(event, packed, room=f"user_{user_id}_bin")
+
+
 @app.before_request
 def require_login_for_chat():
+    # Uploads are only reachable through signed /media URLs.
+    if request.path.startswith("/static/uploads/"):
+        return jsonify({"error": "Not found"}), 404
     public_routes = {"login", "signup", "static"}
     if request.endpoint in public_routes or request.endpoint is None:
         return
@@ -209,6 +1419,8 @@ def require_login_for_chat():
         "api_friend_search",
         "api_add_friend",
         "api_remove_friend",
+        "api_stats",
+        "api_search",
     }:
         if "user_id" not in session:
             return redirect(url_for("login"))
@@ -231,15 +1443,22 @@ def signup():
         if len(username) < 3 or "@" not in email or len(password) < 6:
             return render_template("signup.html", error="Invalid input. Use valid email and 6+ char password.")
 
-        password_hash = generate_password_hash(password)
+        try:
+            password_hash = password_hasher.hash(password)
+        except HasherBusy:
+            return render_template("signup.html", error="Server is busy. Please try again in a moment."), 503
         default_avatar = f"https://ui-avatars.com/api/?name={username}&background=1b9aaa&color=fff"
 
         conn = get_db()
         try:
             cur = conn.execute(
-                "INSERT INTO users (username, email, password_hash, avatar_url, created_at, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
-                (username, email, password_hash, default_avatar, now_iso(), now_iso()),
+                "INSERT INTO users (username, username_lc, email, password_hash, avatar_url, created_at, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (username, username.lower(), email, password_hash, default_avatar, now_iso(), now_iso()),
             )
+            if user_trigram_enabled:
+                conn.execute(
+                    "INSERT INTO users_search (rowid, username, email) VALUES (?, ?, ?)", (cur.lastrowid, username, email)
+                )
             conn.commit()
             session["user_id"] = cur.lastrowid
             return redirect(url_for("chat"))
@@ -263,9 +1482,25 @@ def login():
         ).fetchone()
         conn.close()
 
-        if not user or not check_password_hash(user["password_hash"], password):
+        try:
+            valid = bool(user) and password_hasher.check(user["password_hash"], password)
+        except HasherBusy:
+            return render_template("login.html", error="Server is busy. Please try again in a moment."), 503
+        if not valid:
             return render_template("login.html", error="Invalid email or password.")
 
+        try:
+            # Upgrade hashes made under an older method/work factor while we have the plaintext.
+            if password_hasher.needs_rehash(user["password_hash"]):
+                conn = get_db()
+                conn.execute(
+                    "UPDATE users SET password_hash = ? WHERE id = ?", (password_hasher.hash(password), user["id"])
+                )
+                conn.commit()
+                conn.close()
+        except HasherBusy:
+            pass
+
         session["user_id"] = user["id"]
         return redirect(url_for("chat"))
 
@@ -283,7 +1518,7 @@ def chat():
     user = auth_user()
     if not user:
         return redirect(url_for("login"))
-    return render_template("chat.html", me=dict(user))
+    return render_template("chat.html", me=dict(user, avatar_url=sign_media_url(user["avatar_url"])))
 
 
 @app.route("/api/me")
@@ -291,217 +1526,936 @@ def api_me():
     user = auth_user()
     if not user:
         return jsonify({"error": "Unauthorized"}), 401
-    return jsonify(dict(user))
+    return jsonify(dict(user, avatar_url=sign_media_url(user["avatar_url"])))
+
+
+@app.route("/api/stats")
+def api_stats():
+    return jsonify(
+        {
+            "user_cache": user_cache.stats(),
+            "friends_cache": friends_cache.stats(),
+            "message_writer": message_writer.stats(),
+            "db_pool": {"write": write_pool.stats(), "read": read_pool.stats()},
+        }
+    )
+
+
+@app.route("/api/contacts")
+def api_contacts():
+    me = session["user_id"]
+    since = request.args.get("since", type=int)
+    conn = get_db()
+    if since is None:
+        etag = contacts_etag(conn, me)
+        if request.if_none_match.contains(etag):
+            conn.close()
+            return not_modified(etag)
+        contacts = conn.execute(
+            f"""
+            {CONTACTS_QUERY}
+            WHERE f.user_id = ? AND u.id != ?
+            ORDER BY sort_time DESC
+            """,
+            (me, me),
+        ).fetchall()
+        conn.close()
+        result = contact_items(contacts)
+        response = jsonify(result)
+        response.headers["X-Contacts-Cursor"] = str(max((r["change_id"] for r in result), default=0))
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    changed = conn.execute(
+        """
+        SELECT c.peer_id, c.change_id, f.id AS friend_row
+        FROM conversations c
+        LEFT JOIN friends f ON f.user_id = c.user_id AND f.friend_id = c.peer_id
+        WHERE c.user_id = ? AND c.change_id > ?
+        ORDER BY c.change_id ASC
+        """,
+        (me, since),
+    ).fetchall()
+    peer_ids = [r["peer_id"] for r in changed if r["friend_row"]]
+    contacts = []
+    if peer_ids:
+        placeholders = ",".join(["?"] * len(peer_ids))
+        contacts = conn.execute(
+            f"{CONTACTS_QUERY} WHERE f.user_id = ? AND f.friend_id IN ({placeholders})",
+            (me, *peer_ids),
+        ).fetchall()
+    conn.close()
+
+    return jsonify(
+        {
+            "contacts": contact_items(contacts),
+            "removed": [r["peer_id"] for r in changed if not r["friend_row"]],
+            "cursor": max([since, *(r["change_id"] for r in changed)]),
+        }
+    )
+
+
+PREFIX_END = chr(0x10FFFF)
+
+
+def friend_search_bucket(conn, me, q, bucket, after, limit):
+    """One rank tier of friend search, in (username_lc, id) order after the keyset position `after`.
+
+    Tier 0 is username prefix, 1 is email prefix, 2 is substring anywhere; later tiers skip rows
+    an earlier tier already returned.
+    """
+    hi = q + PREFIX_END
+    if bucket == 0:
+        source, match, params = "users u", "u.username_lc >= ? AND u.username_lc < ?", [q, hi]
+    elif bucket == 1:
+        source = "users u"
+        match = "u.email >= ? AND u.email < ? AND NOT (u.username_lc >= ? AND u.username_lc < ?)"
+        params = [q, hi, q, hi]
+    else:
+        not_prefix = "NOT (u.username_lc >= ? AND u.username_lc < ?) AND NOT (u.email >= ? AND u.email < ?)"
+        if user_trigram_enabled and len(q) >= 3:
+            source = "users_search JOIN users u ON u.id = users_search.rowid"
+            match = f"users_search MATCH ? AND {not_prefix}"
+            params = ['"' + q.replace('"', '""') + '"', q, hi, q, hi]
+        else:
+            source, match = "users u", f"(u.username_lc LIKE ? OR u.email LIKE ?) AND {not_prefix}"
+            params = [f"%{q}%", f"%{q}%", q, hi, q, hi]
+    if after:
+        match += " AND (u.username_lc, u.id) > (?, ?)"
+        params += list(after)
+    return conn.execute(
+        f"""
+        SELECT u.id, u.username, u.email, u.avatar_url, u.username_lc
+        FROM {source}
+        WHERE {match} AND u.id != ?
+          AND NOT EXISTS (SELECT 1 FROM friends f WHERE f.user_id = ? AND f.friend_id = u.id)
+        ORDER BY u.username_lc, u.id
+        LIMIT ?
+        """,
+        (*params, me, me, limit),
+    ).fetchall()
+
+
+@app.route("/api/friends/search")
+def api_friend_search():
+    me = session["user_id"]
+    q = (request.args.get("q") or "").strip().lower()
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 50)
+    bucket, after = 0, None
+    cursor = request.args.get("cursor") or ""
+    if cursor:
+        try:
+            bucket, after_id = (int(part) for part in cursor.split(":", 1))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        after = (None, after_id)
+
+    conn = get_db()
+    if after:
+        row = conn.execute("SELECT username_lc FROM users WHERE id = ?", (after[1],)).fetchone()
+        after = (row["username_lc"], after[1]) if row else None
+    hits = []
+    for tier in range(bucket, 3 if q else 1):
+        hits += [(tier, r) for r in friend_search_bucket(conn, me, q, tier, after, limit + 1 - len(hits))]
+        after = None
+        if len(hits) > limit:
+            break
+    conn.close()
+
+    resp = jsonify(
+        [dict(id=r["id"], username=r["username"], email=r["email"], avatar_url=sign_media_url(r["avatar_url"]))
+         for _, r in hits[:limit]]
+    )
+    if len(hits) > limit:
+        tier, last = hits[limit - 1]
+        resp.headers["X-Next-Cursor"] = f"{tier}:{last['id']}"
+    return resp
+
+
+@app.route("/api/friends/add", methods=["POST"])
+def api_add_friend():
+    me = int(session["user_id"])
+    payload = request.get_json(silent=True) or {}
+    friend_id = int(payload.get("friend_id") or 0)
+    if not friend_id or friend_id == me:
+        return jsonify({"error": "Invalid friend"}), 400
+
+    conn = get_db()
+    target = conn.execute("SELECT id FROM users WHERE id = ?", (friend_id,)).fetchone()
+    if not target:
+        conn.close()
+        return jsonify({"error": "User not found"}), 404
+
+    conn.execute(
+        "INSERT OR IGNORE INTO friends (user_id, friend_id, created_at) VALUES (?, ?, ?)",
+        (me, friend_id, now_iso()),
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO friends (user_id, friend_id, created_at) VALUES (?, ?, ?)",
+        (friend_id, me, now_iso()),
+    )
+    refresh_conversation(conn, me, friend_id)
+    refresh_conversation(conn, friend_id, me)
+    conn.commit()
+    friends_cache.invalidate(me, friend_id)
+    push_contact_updates(conn, [(me, friend_id), (friend_id, me)])
+    conn.close()
+    return jsonify({"ok": True})
+
+
+@app.route("/api/friends/remove", methods=["POST"])
+def api_remove_friend():
+    me = int(session["user_id"])
+    payload = request.get_json(silent=True) or {}
+    friend_id = int(payload.get("friend_id") or 0)
+    if not friend_id:
+        return jsonify({"error": "Invalid friend"}), 400
+    conn = get_db()
+    conn.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (me, friend_id))
+    conn.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (friend_id, me))
+    touch_conversation(conn, me, friend_id)
+    touch_conversation(conn, friend_id, me)
+    conn.commit()
+    friends_cache.invalidate(me, friend_id)
+    push_contact_updates(conn, [(me, friend_id), (friend_id, me)])
+    conn.close()
+    return jsonify({"ok": True})
+
+
+MESSAGE_PAGE_QUERY = """
+    SELECT m.id, m.sender_id, m.recipient_id, m.content, m.image_url, m.media_url, m.media_type,
+           m.file_name, m.file_size, m.duration_sec, m.waveform, m.reply_to_id,
+           m.forwarded_from_id,
+           CASE
+             WHEN m.id <= COALESCE(w.last_read_id, 0) THEN 'seen'
+             WHEN m.id <= COALESCE(w.last_delivered_id, 0) THEN 'delivered'
+             ELSE 'sent'
+           END AS status,
+           m.created_at, m.edited_at, m.deleted_at,
+           s.username AS sender_name,
+           rs.username AS reply_sender_name,
+           rm.content AS reply_content,
+           rm.image_url AS reply_image_url
+    FROM messages m
+    JOIN users s ON s.id = m.sender_id
+    LEFT JOIN conversations w ON w.user_id = m.recipient_id AND w.peer_id = m.sender_id
+    LEFT JOIN messages rm ON rm.id = m.reply_to_id
+    LEFT JOIN users rs ON rs.id = rm.sender_id
+    WHERE m.conversation_id = ?
+      AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
+      {range_clause}
+    ORDER BY m.id {order}
+    LIMIT ?
+"""
+
+
+def encode_message_cursor(message_id):
+    return base64.urlsafe_b64encode(f"m{message_id}".encode()).rstrip(b"=").decode()
+
+
+def decode_message_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return int(raw[1:]) if raw[:1] == "m" and raw[1:].isdigit() else None
+
+
+def message_window(conn, me, peer_id, range_clause, params, descending, limit):
+    """One keyset range scan over idx_messages_conversation (conversation_id, id).
+
+    Returns up to `limit` rows oldest-first, and whether more rows lie beyond them in the scan direction.
+    """
+    # With no room left (limit 0) this is still a LIMIT 1 probe, so the flag stays exact.
+    limit = max(limit, 0)
+    rows = conn.execute(
+        MESSAGE_PAGE_QUERY.format(range_clause=range_clause, order="DESC" if descending else "ASC"),
+        (conversation_key(me, peer_id), me, *params, limit + 1),
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return (list(reversed(rows)) if descending else rows), more
+
+
+@app.route("/api/messages/<int:peer_id>")
+def api_messages(peer_id):
+    """History pages. With no anchor, the newest messages; `before`/`after` take the cursors of a previous
+    page (or raw `before_id`/`after_id`), and `around=<message_id>` centres the page on that message."""
+    me = session["user_id"]
+    limit = min(max(int(request.args.get("limit", 30)), 1), 100)
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    around_id = request.args.get("around", type=int)
+    for name in ("before", "after"):
+        cursor = request.args.get(name)
+        if cursor is None:
+            continue
+        decoded = decode_message_cursor(cursor)
+        if decoded is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+        if name == "before":
+            before_id = decoded
+        else:
+            after_id = decoded
+
+    conn = get_read_db()
+    if not can_access_pair(conn, me, peer_id):
+        conn.close()
+        return jsonify({"error": "Contact not found"}), 404
+    etag = messages_etag(conn, me, peer_id)
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return not_modified(etag)
+
+    if around_id:
+        older, has_older = message_window(conn, me, peer_id, "AND m.id <= ?", (around_id,), True, limit // 2 + 1)
+        newer, has_newer = message_window(conn, me, peer_id, "AND m.id > ?", (around_id,), False, limit - len(older))
+        rows = older + newer
+    elif after_id is not None:
+        rows, has_newer = message_window(conn, me, peer_id, "AND m.id > ?", (after_id,), False, limit)
+        has_older = True
+    elif before_id:
+        rows, has_older = message_window(conn, me, peer_id, "AND m.id < ?", (before_id,), True, limit)
+        has_newer = True
+    else:
+        rows, has_older = message_window(conn, me, peer_id, "", (), True, limit)
+        has_newer = False
+
+    messages = serialize_messages(conn, rows, me)
+    conn.close()
+
+    # An empty catch-up page hands back its own anchor, so the client can poll `after` again later.
+    newest = rows[-1]["id"] if rows else after_id
+    response = jsonify(
+        {
+            "messages": messages,
+            "has_more": has_older,
+            "has_older": has_older,
+            "has_newer": has_newer,
+            "before": encode_message_cursor(rows[0]["id"]) if rows else None,
+            "after": encode_message_cursor(newest) if newest is not None else None,
+        }
+    )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/search")
+def api_search():
+    me = session["user_id"]
+    peer_id = request.args.get("peer_id", type=int)
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 50)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    match = fts_query(request.args.get("q") or "")
+    if not search_enabled:
+        return jsonify({"error": "Search unavailable"}), 503
+    if not match:
+        return jsonify({"results": [], "next_offset": None})
+
+    params = [match, me, me, me]
+    peer_clause = ""
+    if peer_id:
+        peer_clause = "AND m.conversation_id = ?"
+        params.append(conversation_key(me, peer_id))
+
+    conn = get_db()
+    rows = conn.execute(
+        f"""
+        SELECT m.id, m.sender_id, m.recipient_id, m.media_type, m.file_name, m.created_at,
+               s.username AS sender_name,
+               snippet(messages_fts, -1, char(2), char(3), '...', 12) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN users s ON s.id = m.sender_id
+        WHERE messages_fts MATCH ?
+          AND (m.sender_id = ? OR m.recipient_id = ?)
+          AND m.deleted_at IS NULL
+          AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
+          {peer_clause}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit, offset),
+    ).fetchall()
+    conn.close()
+
+    results = []
+    for row in rows:
+        item = dict(row)
+        item["peer_id"] = row["recipient_id"] if int(row["sender_id"]) == int(me) else row["sender_id"]
+        results.append(item)
+    return jsonify({"results": results, "next_offset": offset + limit if len(rows) == limit else None})
+
+
+@app.route("/media/<path:filename>")
+def serve_media(filename):
+    """Uploads behind an expiring HMAC signature (no DB check); Range/ETag via send_from_directory or nginx."""
+    exp = request.args.get("exp")
+    if not verify_media_signature(f"/media/{filename}", exp, request.args.get("sig")):
+        return jsonify({"error": "Forbidden"}), 403
+
+    sha256 = media_sha(f"/media/{filename}")
+    if MEDIA_ACCEL_REDIRECT:
+        path = safe_join(str(UPLOAD_DIR), filename)
+        if not path or not os.path.isfile(path):
+            return jsonify({"error": "Not found"}), 404
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_REDIRECT}/{filename}"
+    else:
+        response = send_from_directory(UPLOAD_DIR, filename, etag=sha256 or True)
+    response.cache_control.no_cache = None
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = max(int(exp) - int(time.time()), 0)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/upload/media", methods=["POST"])
+def upload_media():
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if "media" not in request.files:
+        return jsonify({"error": "No media uploaded"}), 400
+
+    media = request.files["media"]
+    if media.filename == "":
+        return jsonify({"error": "No selected file"}), 400
+
+    requested_type = (request.form.get("media_type") or "").strip().lower() or None
+    media_type = classify_media(media.filename, preferred_type=requested_type)
+    if not media_type:
+        return jsonify({"error": "Unsupported media format"}), 400
+
+    ext = media.filename.rsplit(".", 1)[1].lower()
+    spool, sha256 = spool_upload(media.stream)
+    conn = get_db()
+    stored = file_media(conn, spool, sha256, ext)
+    queue_preview(conn, stored, media_type)
+    conn.close()
+    return media_upload_response(stored, media.filename, media_type)
+
+
+def media_upload_response(stored, original_name, media_type):
+    return jsonify(
+        {
+            "media_url": sign_media_url(media_href(stored["path"])),
+            "media_type": media_type,
+            "file_name": secure_filename(original_name),
+            "file_size": stored["size"],
+        }
+    )
+
+
+media_store_lock = threading.Lock()
+
+
+def media_object_path(sha256, ext):
+    return MEDIA_STORE_DIR / sha256[:2] / sha256[2:4] / f"{sha256}.{ext}"
+
+
+def spool_upload(stream):
+    """Copy an upload stream to a scratch file, hashing it on the way. Returns (path, sha256 hex)."""
+    digest = hashlib.sha256()
+    spool = UPLOAD_TMP_DIR / f"{uuid.uuid4().hex}.spool"
+    with open(spool, "wb") as out:
+        for block in iter(lambda: stream.read(64 * 1024), b""):
+            digest.update(block)
+            out.write(block)
+    return spool, digest.hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_media(conn, spool, sha256, ext):
+    """Move a hashed scratch file into the content-addressed store, or drop it if the blob is already there.
+
+    The blob starts unreferenced; messages and avatars that use it take references. Returns {sha256, path, size}
+    with `path` relative to static/.
+    """
+    with media_store_lock:
+        row = conn.execute("SELECT path, size FROM media_objects WHERE sha256 = ?", (sha256,)).fetchone()
+        if row:
+            spool.unlink(missing_ok=True)
+            conn.execute("UPDATE media_objects SET updated_at = ? WHERE sha256 = ?", (now_iso(), sha256))
+            stored = {"sha256": sha256, "path": row["path"], "size": row["size"]}
+        else:
+            target = media_object_path(sha256, ext)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(spool, target)
+            stored = {
+                "sha256": sha256,
+                "path": target.relative_to(UPLOAD_DIR.parent).as_posix(),
+                "size": target.stat().st_size,
+            }
+            conn.execute(
+                """
+                INSERT INTO media_objects (sha256, path, size, ref_count, created_at, updated_at)
+                VALUES (?, ?, ?, 0, ?, ?)
+                """,
+                (sha256, stored["path"], stored["size"], now_iso(), now_iso()),
+            )
+        conn.commit()
+    return stored
+
+
+def media_href(path):
+    """Public URL for a file stored under static/uploads (`path` is relative to static/)."""
+    return "/media/" + path.removeprefix("uploads/")
+
+
+def media_url_window():
+    return int(time.time()) // MEDIA_URL_TTL_SEC
+
+
+def media_signature(path, exp):
+    mac = hmac.new(app.secret_key.encode(), f"{path}\n{exp}".encode(), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(mac).rstrip(b"=").decode()
+
+
+def verify_media_signature(path, exp, sig):
+    # isdigit() alone accepts "²", and compare_digest() raises on non-ASCII str: both must be a plain 403.
+    if not exp or not sig or not (exp.isascii() and exp.isdigit()) or int(exp) < time.time():
+        return False
+    return hmac.compare_digest(sig.encode(), media_signature(path, int(exp)).encode())
+
+
+def sign_media_url(url):
+    """Append exp/sig to a stored /media URL; anything else is returned unchanged."""
+    if not url or not url.startswith("/media/"):
+        return url
+    exp = (media_url_window() + 2) * MEDIA_URL_TTL_SEC
+    return f"{url}?exp={exp}&sig={media_signature(url, exp)}"
+
+
+def sign_message_urls(item):
+    for key in ("image_url", "media_url", "thumb_url", "reply_image_url"):
+        if item.get(key):
+            item[key] = sign_media_url(item[key])
+    if item.get("reply_preview") and item["reply_preview"].get("image_url"):
+        item["reply_preview"]["image_url"] = sign_media_url(item["reply_preview"]["image_url"])
+    return item
+
+
+def canonical_media_url(url):
+    """Stored form of a media URL a client sends back.
+
+    A /media URL must carry a valid signature, which proves the sender was shown the file, and is stored
+    without it. Unsigned upload URLs are refused (""); URLs outside the upload store pass through.
+    """
+    if url.startswith("/media/"):
+        path, _, query = url.partition("?")
+        args = parse_qs(query)
+        exp, sig = (args.get("exp") or [None])[0], (args.get("sig") or [None])[0]
+        return path if verify_media_signature(path, exp, sig) else ""
+    if url.startswith("/static/uploads/"):
+        return ""
+    return url
+
+
+def media_sha(url):
+    match = MEDIA_URL_RE.search(url or "")
+    return match.group(1) if match else None
+
+
+def media_refs(*urls):
+    return {media_sha(url) for url in urls} - {None}
+
+
+def retain_media(conn, *urls):
+    conn.executemany(
+        "UPDATE media_objects SET ref_count = ref_count + 1 WHERE sha256 = ?", [(sha,) for sha in media_refs(*urls)]
+    )
+
+
+def release_media(conn, *urls):
+    # Restart the GC grace period: URLs signed while the blob was referenced can still be sent again.
+    conn.executemany(
+        "UPDATE media_objects SET ref_count = MAX(ref_count - 1, 0), updated_at = ? WHERE sha256 = ?",
+        [(now_iso(), sha) for sha in media_refs(*urls)],
+    )
+
+
+def media_missing(conn, *urls):
+    """True if any of these store URLs points at a blob the GC has already deleted."""
+    shas = media_refs(*urls)
+    if not shas:
+        return False
+    placeholders = ",".join(["?"] * len(shas))
+    found = conn.execute(f"SELECT COUNT(*) FROM media_objects WHERE sha256 IN ({placeholders})", tuple(shas)).fetchone()
+    return found[0] < len(shas)
+
+
+def collect_media(conn):
+    """Delete unreferenced blobs. A blob (re)uploaded within the grace period is kept: it may be about to be sent."""
+    cutoff = (datetime.utcnow() - timedelta(hours=MEDIA_GC_GRACE_HOURS)).isoformat(timespec="seconds") + "Z"
+    with media_store_lock:
+        rows = conn.execute(
+            """
+            SELECT o.sha256, o.path, p.thumb_path
+            FROM media_objects o
+            LEFT JOIN media_previews p ON p.sha256 = o.sha256
+            WHERE o.ref_count = 0 AND o.updated_at < ?
+            """,
+            (cutoff,),
+        ).fetchall()
+        removed = [
+            row
+            for row in rows
+            if conn.execute("DELETE FROM media_objects WHERE sha256 = ? AND ref_count = 0", (row["sha256"],)).rowcount
+        ]
+        conn.executemany("DELETE FROM media_previews WHERE sha256 = ?", [(row["sha256"],) for row in removed])
+        conn.commit()
+        for row in removed:
+            for path in (row["path"], row["thumb_path"]):
+                if path:
+                    (UPLOAD_DIR.parent / path).unlink(missing_ok=True)
+    return len(removed)
+
+
+BLURHASH_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def base83(value, length):
+    return "".join(BLURHASH_CHARS[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def srgb_to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value):
+    v = min(max(value, 0.0), 1.0)
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash_encode(pixels, width, height, x_components=4, y_components=3):
+    """Encode row-major RGB tuples as a blurhash (https://blurha.sh); callers pass a small downscaled image."""
+    linear = [tuple(srgb_to_linear(c) for c in px) for px in pixels]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                for x in range(width):
+                    basis = cos_x[i][x] * cos_y[j][y]
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = (1 if i == j == 0 else 2) / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    out = base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        quantised = max(0, min(82, int(max(abs(c) for f in ac for c in f) * 166 - 0.5)))
+        maximum = (quantised + 1) / 166
+    else:
+        quantised, maximum = 0, 1
+    out += base83(quantised, 1)
+    out += base83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for f in ac:
+        q = [max(0, min(18, int(math.copysign(abs(c / maximum) ** 0.5, c) * 9 + 9.5))) for c in f]
+        out += base83(q[0] * 19 * 19 + q[1] * 19 + q[2], 2)
+    return out
+
+
+def poster_frame(path):
+    """First usable video frame via ffmpeg (one second in, or the very start for short clips), or None."""
+    for offset in ("1", "0"):
+        result = subprocess.run(
+            [FFMPEG_BIN, "-v", "error", "-ss", offset, "-i", str(path), "-frames:v", "1", "-f", "image2pipe",
+             "-vcodec", "png", "-"],
+            capture_output=True,
+            timeout=30,
+        )
+        if result.returncode == 0 and result.stdout:
+            return Image.open(io.BytesIO(result.stdout))
+    return None
+
+
+def build_preview(sha256, source, media_type):
+    """Worker body: write <sha256>.thumb.jpg next to the blob and record its dimensions and blurhash."""
+    try:
+        if media_type == "video":
+            image = poster_frame(source)
+            if image is None:
+                return
+        else:
+            image = Image.open(source)
+        # Original dimensions, upright: draft() below shrinks image.size, and EXIF 5-8 rotates by 90 degrees.
+        width, height = image.size
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+        image.draft("RGB", (PREVIEW_MAX_PX * 2, PREVIEW_MAX_PX * 2))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((PREVIEW_MAX_PX, PREVIEW_MAX_PX))
+        thumb = source.with_name(f"{sha256}.thumb.jpg")
+        image.save(thumb, "JPEG", quality=80, optimize=True)
+        small = image.resize((32, 32))
+        blurhash = blurhash_encode(list(small.getdata()), 32, 32)
+
+        conn = get_db()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO media_previews (sha256, thumb_path, width, height, blurhash, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (sha256, thumb.relative_to(UPLOAD_DIR.parent).as_posix(), width, height, blurhash, now_iso()),
+        )
+        # History pages already sent without the preview fields must fail their ETag check.
+        url = media_href(source.relative_to(UPLOAD_DIR.parent).as_posix())
+        pairs = conn.execute(
+            "SELECT DISTINCT sender_id, recipient_id FROM messages WHERE media_url = ? OR image_url = ?", (url, url)
+        ).fetchall()
+        for pair in pairs:
+            touch_conversation(conn, pair["sender_id"], pair["recipient_id"])
+            touch_conversation(conn, pair["recipient_id"], pair["sender_id"])
+        conn.commit()
+        conn.close()
+    except Exception:
+        app.logger.exception("preview failed for %s", sha256)
+    finally:
+        with preview_guard:
+            previews_pending.discard(sha256)
+
+
+preview_pool = ThreadPoolExecutor(max_workers=max(PREVIEW_WORKERS, 1), thread_name_prefix="preview")
+preview_guard = threading.Lock()
+previews_pending = set()
+
+
+def queue_preview(conn, stored, media_type):
+    """Hand a freshly stored image/video to the preview pool unless it already has (or is getting) a preview."""
+    if Image is None or not PREVIEW_WORKERS or media_type not in {"image", "video"}:
+        return
+    if media_type == "video" and not FFMPEG_BIN:
+        return
+    if conn.execute("SELECT 1 FROM media_previews WHERE sha256 = ?", (stored["sha256"],)).fetchone():
+        return
+    with preview_guard:
+        if stored["sha256"] in previews_pending:
+            return
+        previews_pending.add(stored["sha256"])
+    preview_pool.submit(build_preview, stored["sha256"], UPLOAD_DIR.parent / stored["path"], media_type)
+
+
+def load_previews(conn, urls):
+    """Preview fields (thumb_url, width, height, blurhash) for each stored media URL that has one."""
+    by_sha = {}
+    for url in urls:
+        sha = media_sha(url)
+        if sha:
+            by_sha.setdefault(sha, []).append(url)
+    if not by_sha:
+        return {}
+    placeholders = ",".join(["?"] * len(by_sha))
+    rows = conn.execute(
+        f"SELECT sha256, thumb_path, width, height, blurhash FROM media_previews WHERE sha256 IN ({placeholders})",
+        list(by_sha),
+    ).fetchall()
+    previews = {}
+    for row in rows:
+        fields = {
+            "thumb_url": media_href(row["thumb_path"]),
+            "width": row["width"],
+            "height": row["height"],
+            "blurhash": row["blurhash"],
+        }
+        for url in by_sha[row["sha256"]]:
+            previews[url] = fields
+    return previews
+
+
+upload_locks = {}
+upload_locks_guard = threading.Lock()
 
 
-@app.route("/api/contacts")
-def api_contacts():
-    me = session["user_id"]
-    conn = get_db()
-    contacts = conn.execute(
-        """
-        SELECT u.id, u.username, u.email, u.avatar_url, u.last_seen,
-               (
-                 SELECT COALESCE(m.content, m.file_name, '[media]')
-                 FROM messages m
-                 WHERE ((m.sender_id = u.id AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = u.id))
-                   AND NOT EXISTS (
-                      SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?
-                   )
-                 ORDER BY m.created_at DESC
-                 LIMIT 1
-               ) AS last_message,
-               (
-                 SELECT m.created_at
-                 FROM messages m
-                 WHERE ((m.sender_id = u.id AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = u.id))
-                   AND NOT EXISTS (
-                      SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?
-                   )
-                 ORDER BY m.created_at DESC
-                 LIMIT 1
-               ) AS last_message_time,
-               (
-                 SELECT COUNT(*)
-                 FROM messages m
-                 WHERE m.sender_id = u.id AND m.recipient_id = ? AND m.status != 'seen' AND m.deleted_at IS NULL
-                   AND NOT EXISTS (
-                      SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?
-                   )
-               ) AS unread_count
-        FROM users u
-        JOIN friends f ON f.friend_id = u.id AND f.user_id = ?
-        WHERE u.id != ?
-        ORDER BY COALESCE(last_message_time, u.created_at) DESC
-        """,
-        (me, me, me, me, me, me, me, me, me, me),
-    ).fetchall()
-    conn.close()
+def upload_part_path(upload_id):
+    return UPLOAD_TMP_DIR / f"{upload_id}.part"
 
-    result = []
-    for row in contacts:
-        item = dict(row)
-        item["is_online"] = row["id"] in online_users
-        item["device_count"] = len(user_sockets.get(row["id"], set()))
-        result.append(item)
 
-    return jsonify(result)
+def purge_stale_uploads(conn):
+    cutoff = (datetime.utcnow() - timedelta(hours=UPLOAD_TTL_HOURS)).isoformat(timespec="seconds") + "Z"
+    stale = conn.execute("SELECT id FROM uploads WHERE updated_at < ?", (cutoff,)).fetchall()
+    for row in stale:
+        upload_part_path(row["id"]).unlink(missing_ok=True)
+    conn.executemany("DELETE FROM uploads WHERE id = ?", [(row["id"],) for row in stale])
+    with upload_locks_guard:
+        for row in stale:
+            upload_locks.pop(row["id"], None)
 
 
-@app.route("/api/friends/search")
-def api_friend_search():
-    me = session["user_id"]
-    q = (request.args.get("q") or "").strip().lower()
+def load_upload(conn, upload_id):
+    return conn.execute(
+        "SELECT * FROM uploads WHERE id = ? AND user_id = ?", (upload_id, session["user_id"])
+    ).fetchone()
+
+
+def upload_lock(upload_id):
+    """The per-upload lock shared by PATCH and finalize, or None if the session has no such upload."""
     conn = get_db()
-    rows = conn.execute(
-        """
-        SELECT u.id, u.username, u.email, u.avatar_url
-        FROM users u
-        LEFT JOIN friends f ON f.friend_id = u.id AND f.user_id = ?
-        WHERE u.id != ? AND f.id IS NULL
-          AND (? = '' OR LOWER(u.username) LIKE ? OR LOWER(u.email) LIKE ?)
-        ORDER BY u.username ASC
-        LIMIT 20
-        """,
-        (me, me, q, f"%{q}%", f"%{q}%"),
-    ).fetchall()
+    upload = load_upload(conn, upload_id)
     conn.close()
-    return jsonify([dict(r) for r in rows])
+    if not upload:
+        return None
+    with upload_locks_guard:
+        return upload_locks.setdefault(upload_id, threading.Lock())
 
 
-@app.route("/api/friends/add", methods=["POST"])
-def api_add_friend():
-    me = int(session["user_id"])
+@app.route("/upload/media/init", methods=["POST"])
+def upload_media_init():
+    """Start a resumable upload; the body is sent afterwards as raw PATCH chunks at explicit offsets."""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
     payload = request.get_json(silent=True) or {}
-    friend_id = int(payload.get("friend_id") or 0)
-    if not friend_id or friend_id == me:
-        return jsonify({"error": "Invalid friend"}), 400
+    file_name = (payload.get("file_name") or "").strip()
+    try:
+        file_size = int(payload.get("file_size") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid file size"}), 400
+    requested_type = (payload.get("media_type") or "").strip().lower() or None
+    media_type = classify_media(file_name, preferred_type=requested_type)
+    if not file_name or not media_type:
+        return jsonify({"error": "Unsupported media format"}), 400
+    if file_size <= 0 or file_size > MAX_RESUMABLE_UPLOAD_MB * 1024 * 1024:
+        return jsonify({"error": f"File must be under {MAX_RESUMABLE_UPLOAD_MB} MB"}), 413
 
+    upload_id = uuid.uuid4().hex
+    upload_part_path(upload_id).touch()
     conn = get_db()
-    target = conn.execute("SELECT id FROM users WHERE id = ?", (friend_id,)).fetchone()
-    if not target:
-        conn.close()
-        return jsonify({"error": "User not found"}), 404
-
-    conn.execute(
-        "INSERT OR IGNORE INTO friends (user_id, friend_id, created_at) VALUES (?, ?, ?)",
-        (me, friend_id, now_iso()),
-    )
+    purge_stale_uploads(conn)
     conn.execute(
-        "INSERT OR IGNORE INTO friends (user_id, friend_id, created_at) VALUES (?, ?, ?)",
-        (friend_id, me, now_iso()),
+        """
+        INSERT INTO uploads (id, user_id, file_name, media_type, file_size, received, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+        """,
+        (upload_id, session["user_id"], file_name[:255], media_type, file_size, now_iso(), now_iso()),
     )
     conn.commit()
     conn.close()
-    return jsonify({"ok": True})
+    return jsonify({"upload_id": upload_id, "offset": 0, "chunk_size": UPLOAD_CHUNK_BYTES}), 201
 
 
-@app.route("/api/friends/remove", methods=["POST"])
-def api_remove_friend():
-    me = int(session["user_id"])
-    payload = request.get_json(silent=True) or {}
-    friend_id = int(payload.get("friend_id") or 0)
-    if not friend_id:
-        return jsonify({"error": "Invalid friend"}), 400
+@app.route("/upload/media/<upload_id>", methods=["GET"])
+def upload_media_offset(upload_id):
+    """Offset query: how many bytes the server holds, so a client can resume after a dropped connection."""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
     conn = get_db()
-    conn.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (me, friend_id))
-    conn.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (friend_id, me))
-    conn.commit()
+    upload = load_upload(conn, upload_id)
     conn.close()
-    return jsonify({"ok": True})
-
-
-@app.route("/api/messages/<int:peer_id>")
-def api_messages(peer_id):
-    me = session["user_id"]
-    limit = min(max(int(request.args.get("limit", 30)), 1), 100)
-    before_id = request.args.get("before_id", type=int)
-
-    conn = get_db()
-    if not can_access_pair(conn, me, peer_id):
-        conn.close()
-        return jsonify({"error": "Contact not found"}), 404
-
-    params = [me, peer_id, peer_id, me, me]
-    before_clause = ""
-    if before_id:
-        before_clause = "AND m.id < ?"
-        params.append(before_id)
-
-    rows = conn.execute(
-        f"""
-        SELECT m.id, m.sender_id, m.recipient_id, m.content, m.image_url, m.media_url, m.media_type,
-               m.file_name, m.file_size, m.duration_sec, m.waveform_json, m.reply_to_id,
-               m.forwarded_from_id, m.status, m.created_at, m.edited_at, m.deleted_at,
-               s.username AS sender_name,
-               rs.username AS reply_sender_name,
-               rm.content AS reply_content,
-               rm.image_url AS reply_image_url
-        FROM messages m
-        JOIN users s ON s.id = m.sender_id
-        LEFT JOIN messages rm ON rm.id = m.reply_to_id
-        LEFT JOIN users rs ON rs.id = rm.sender_id
-        WHERE ((m.sender_id = ? AND m.recipient_id = ?) OR (m.sender_id = ? AND m.recipient_id = ?))
-          AND NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.message_id = m.id AND h.user_id = ?)
-          {before_clause}
-        ORDER BY m.id DESC
-        LIMIT ?
-        """,
-        (*params, limit),
-    ).fetchall()
-
-    has_more = len(rows) == limit
-    rows_asc = list(reversed(rows))
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    response = jsonify({"offset": upload["received"], "file_size": upload["file_size"]})
+    response.headers["Upload-Offset"] = str(upload["received"])
+    response.headers["Upload-Length"] = str(upload["file_size"])
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@app.route("/upload/media/<upload_id>", methods=["PATCH"])
+def upload_media_append(upload_id):
+    """Append one raw chunk at Upload-Offset, streaming it to disk; bytes that arrive before a drop are kept."""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    offset = request.headers.get("Upload-Offset", type=int)
+    if offset is None:
+        return jsonify({"error": "Upload-Offset header required"}), 400
+
+    lock = upload_lock(upload_id)
+    if lock is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if not lock.acquire(blocking=False):
+        return jsonify({"error": "Upload busy"}), 409
+    try:
+        conn = get_db()
+        upload = load_upload(conn, upload_id)
+        if not upload:
+            conn.close()
+            return jsonify({"error": "Upload not found"}), 404
+        if offset != upload["received"]:
+            conn.close()
+            return jsonify({"error": "Offset mismatch", "offset": upload["received"]}), 409
+
+        remaining = upload["file_size"] - offset
+        written = 0
+        disconnected = False
+        with open(upload_part_path(upload_id), "r+b") as part:
+            part.seek(offset)
+            part.truncate()
+            try:
+                while written < remaining:
+                    block = request.stream.read(min(64 * 1024, remaining - written))
+                    if not block:
+                        break
+                    part.write(block)
+                    written += len(block)
+            except ClientDisconnected:
+                disconnected = True
 
-    seen_rows = conn.execute(
-        "SELECT id FROM messages WHERE sender_id = ? AND recipient_id = ? AND status != 'seen'",
-        (peer_id, me),
-    ).fetchall()
-    seen_ids = [r["id"] for r in seen_rows]
-    if seen_ids:
         conn.execute(
-            "UPDATE messages SET status = 'seen' WHERE sender_id = ? AND recipient_id = ? AND status != 'seen'",
-            (peer_id, me),
+            "UPDATE uploads SET received = ?, updated_at = ? WHERE id = ?",
+            (offset + written, now_iso(), upload_id),
         )
-        socketio.emit("message_status", {"message_ids": seen_ids, "status": "seen"}, room=f"user_{peer_id}")
-
-    conn.commit()
-    messages = serialize_messages(conn, rows_asc, me)
-    conn.close()
+        conn.commit()
+        conn.close()
+    finally:
+        lock.release()
 
-    return jsonify({"messages": messages, "has_more": has_more})
+    if disconnected:
+        return jsonify({"error": "Chunk interrupted", "offset": offset + written}), 400
+    return jsonify({"offset": offset + written, "file_size": upload["file_size"]})
 
 
-@app.route("/upload/media", methods=["POST"])
-def upload_media():
+@app.route("/upload/media/<upload_id>/finalize", methods=["POST"])
+def upload_media_finalize(upload_id):
     if "user_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    if "media" not in request.files:
-        return jsonify({"error": "No media uploaded"}), 400
-
-    media = request.files["media"]
-    if media.filename == "":
-        return jsonify({"error": "No selected file"}), 400
-
-    requested_type = (request.form.get("media_type") or "").strip().lower() or None
-    media_type = classify_media(media.filename, preferred_type=requested_type)
-    if not media_type:
-        return jsonify({"error": "Unsupported media format"}), 400
-
-    ext = media.filename.rsplit(".", 1)[1].lower()
-    filename = secure_filename(f"media_{uuid.uuid4().hex}.{ext}")
-    media_path = UPLOAD_DIR / filename
-    media.save(media_path)
+    # Same lock as PATCH: a duplicate finalize must not find the part file already moved into the store.
+    lock = upload_lock(upload_id)
+    if lock is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if not lock.acquire(blocking=False):
+        return jsonify({"error": "Upload busy"}), 409
+    try:
+        conn = get_db()
+        upload = load_upload(conn, upload_id)
+        if not upload:
+            conn.close()
+            return jsonify({"error": "Upload not found"}), 404
+        if upload["received"] != upload["file_size"]:
+            conn.close()
+            return jsonify({"error": "Upload incomplete", "offset": upload["received"]}), 409
 
-    return jsonify(
-        {
-            "media_url": url_for("static", filename=f"uploads/{filename}"),
-            "media_type": media_type,
-            "file_name": secure_filename(media.filename),
-            "file_size": media_path.stat().st_size,
-        }
-    )
+        ext = upload["file_name"].rsplit(".", 1)[1].lower()
+        part = upload_part_path(upload_id)
+        stored = file_media(conn, part, hash_file(part), ext)
+        queue_preview(conn, stored, upload["media_type"])
+        conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        conn.commit()
+        conn.close()
+        with upload_locks_guard:
+            upload_locks.pop(upload_id, None)
+    finally:
+        lock.release()
+    return media_upload_response(stored, upload["file_name"], upload["media_type"])
 
 
 @app.route("/upload/image", methods=["POST"])
@@ -520,11 +2474,13 @@ def upload_image():
         return jsonify({"error": "Invalid image format"}), 400
 
     ext = image.filename.rsplit(".", 1)[1].lower()
-    filename = secure_filename(f"img_{uuid.uuid4().hex}.{ext}")
-    image_path = UPLOAD_DIR / filename
-    image.save(image_path)
+    spool, sha256 = spool_upload(image.stream)
+    conn = get_db()
+    stored = file_media(conn, spool, sha256, ext)
+    queue_preview(conn, stored, "image")
+    conn.close()
 
-    return jsonify({"image_url": url_for("static", filename=f"uploads/{filename}")})
+    return jsonify({"image_url": sign_media_url(media_href(stored["path"]))})
 
 
 @app.route("/upload/avatar", methods=["POST"])
@@ -540,95 +2496,62 @@ def upload_avatar():
         return jsonify({"error": "Invalid avatar image"}), 400
 
     ext = avatar.filename.rsplit(".", 1)[1].lower()
-    filename = secure_filename(f"avatar_{session['user_id']}_{uuid.uuid4().hex}.{ext}")
-    avatar_path = UPLOAD_DIR / filename
-    avatar.save(avatar_path)
-
-    avatar_url = url_for("static", filename=f"uploads/{filename}")
+    spool, sha256 = spool_upload(avatar.stream)
     conn = get_db()
+    stored = file_media(conn, spool, sha256, ext)
+
+    avatar_url = media_href(stored["path"])
+    previous = conn.execute("SELECT avatar_url FROM users WHERE id = ?", (session["user_id"],)).fetchone()
     conn.execute("UPDATE users SET avatar_url = ? WHERE id = ?", (avatar_url, session["user_id"]))
+    retain_media(conn, avatar_url)
+    release_media(conn, previous["avatar_url"] if previous else None)
+    friend_ids = [
+        r["friend_id"]
+        for r in conn.execute("SELECT friend_id FROM friends WHERE user_id = ?", (session["user_id"],)).fetchall()
+    ]
+    for friend_id in friend_ids:
+        touch_conversation(conn, friend_id, session["user_id"])
     conn.commit()
+    user_cache.invalidate(session["user_id"])
+    push_contact_updates(conn, [(friend_id, session["user_id"]) for friend_id in friend_ids])
     conn.close()
 
-    return jsonify({"avatar_url": avatar_url})
+    return jsonify({"avatar_url": sign_media_url(avatar_url)})
 
 
 @socketio.on("connect")
-def handle_connect():
+def handle_connect(auth=None):
     user = auth_user()
     if not user:
         return False
 
     user_id = int(user["id"])
-    sid = request.sid
-    sid_to_user[sid] = user_id
-    sockets = user_sockets.setdefault(user_id, set())
-    sockets.add(sid)
-    online_users.add(user_id)
+    presence.add(request.sid, user_id)
     join_room(f"user_{user_id}")
+    # Clients that can decode it ask for the compact format with io({auth: {wire: "msgpack"}}).
+    wire = "bin" if msgpack and isinstance(auth, dict) and auth.get("wire") == "msgpack" else "json"
+    join_room(f"user_{user_id}_{wire}")
 
     conn = get_db()
-    emit_message_status_bulk(conn, user_id, "sent", "delivered")
+    delivered = mark_conversation_delivered(conn, user_id)
     conn.commit()
     conn.close()
+    for peer_id, up_to in delivered:
+        emit_read_up_to(user_id, peer_id, up_to, read=False)
 
-    emit(
-        "presence",
-        {
-            "user_id": user_id,
-            "status": "online",
-            "is_online": True,
-            "device_count": len(sockets),
-            "last_seen": None,
-        },
-        broadcast=True,
-    )
+    presence_aggregator.notify(user_id)
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    sid = request.sid
-    user_id = sid_to_user.pop(sid, None) or session.get("user_id")
-    if not user_id:
-        return
-
-    user_id = int(user_id)
-    sockets = user_sockets.get(user_id, set())
-    sockets.discard(sid)
-
-    if sockets:
-        emit(
-            "presence",
-            {
-                "user_id": user_id,
-                "status": "online",
-                "is_online": True,
-                "device_count": len(sockets),
-                "last_seen": None,
-            },
-            broadcast=True,
-        )
-        return
-
-    user_sockets.pop(user_id, None)
-    online_users.discard(user_id)
-    last_seen = now_iso()
-    conn = get_db()
-    conn.execute("UPDATE users SET last_seen = ? WHERE id = ?", (last_seen, user_id))
-    conn.commit()
-    conn.close()
+    user_id, device_count = presence.remove(request.sid)
+    if user_id is None:
+        user_id = session.get("user_id")
+        if not user_id:
+            return
+        device_count = presence.device_count(user_id)
 
-    emit(
-        "presence",
-        {
-            "user_id": user_id,
-            "status": "offline",
-            "is_online": False,
-            "device_count": 0,
-            "last_seen": last_seen,
-        },
-        broadcast=True,
-    )
+    presence_aggregator.notify(user_id, went_offline=not device_count)
 
 
 @socketio.on("join_chat")
@@ -638,24 +2561,17 @@ def handle_join_chat(data):
     if not me or not peer_id:
         return
 
-    join_room(f"chat_{min(int(me), peer_id)}_{max(int(me), peer_id)}")
+    join_room(f"chat_{conversation_key(me, peer_id)}")
 
-    conn = get_db()
-    unseen = conn.execute(
-        "SELECT id FROM messages WHERE sender_id = ? AND recipient_id = ? AND status != 'seen'",
-        (peer_id, me),
-    ).fetchall()
-    ids = [r["id"] for r in unseen]
-    if ids:
-        conn.execute(
-            "UPDATE messages SET status = 'seen' WHERE sender_id = ? AND recipient_id = ? AND status != 'seen'",
-            (peer_id, me),
-        )
-        conn.commit()
-    conn.close()
 
-    if ids:
-        emit("message_status", {"message_ids": ids, "status": "seen"}, room=f"user_{peer_id}")
+@socketio.on("mark_read")
+def handle_mark_read(data):
+    me = session.get("user_id")
+    peer_id = int((data or {}).get("peer_id") or 0)
+    up_to_id = int((data or {}).get("up_to_id") or 0)
+    if not me or not peer_id or up_to_id <= 0:
+        return
+    read_receipts.mark(me, peer_id, up_to_id)
 
 
 @socketio.on("typing")
@@ -680,13 +2596,13 @@ def handle_send_message(data):
 
     recipient_id = int((data or {}).get("recipient_id", 0))
     content = ((data or {}).get("content") or "").strip()
-    image_url = ((data or {}).get("image_url") or "").strip()
-    media_url = ((data or {}).get("media_url") or "").strip()
+    image_url = canonical_media_url(((data or {}).get("image_url") or "").strip())
+    media_url = canonical_media_url(((data or {}).get("media_url") or "").strip())
     media_type = ((data or {}).get("media_type") or "").strip().lower()
     file_name = ((data or {}).get("file_name") or "").strip()
     file_size = int((data or {}).get("file_size") or 0)
     duration_sec = float((data or {}).get("duration_sec") or 0)
-    waveform = (data or {}).get("waveform") or []
+    waveform = pack_waveform((data or {}).get("waveform"))
     reply_to_id = int((data or {}).get("reply_to_id") or 0)
     forwarded_from_id = int((data or {}).get("forwarded_from_id") or 0)
 
@@ -708,28 +2624,27 @@ def handle_send_message(data):
     if duration_sec < 0:
         duration_sec = 0
 
-    if not isinstance(waveform, list):
-        waveform = []
-    waveform = waveform[:80]
 
-    status = "delivered" if recipient_id in online_users else "sent"
+    status = "delivered" if presence.is_online(recipient_id) else "sent"
 
     conn = get_db()
-    if not can_access_pair(conn, me, recipient_id):
+    if not can_access_pair(conn, me, recipient_id) or media_missing(conn, image_url, media_url):
         conn.close()
         return
 
-    valid_reply_to = None
+    reply_row = None
     if reply_to_id:
         reply_row = conn.execute(
             """
-            SELECT id FROM messages
-            WHERE id = ?
-              AND ((sender_id = ? AND recipient_id = ?) OR (sender_id = ? AND recipient_id = ?))
+            SELECT m.id, m.content, m.image_url, u.username AS sender_name
+            FROM messages m
+            JOIN users u ON u.id = m.sender_id
+            WHERE m.id = ? AND m.conversation_id = ?
             """,
-            (reply_to_id, me, recipient_id, recipient_id, me),
+            (reply_to_id, conversation_key(me, recipient_id)),
         ).fetchone()
-        valid_reply_to = reply_to_id if reply_row else None
+        reply_row = dict(reply_row) if reply_row else None
+    valid_reply_to = reply_to_id if reply_row else None
 
     valid_forward = None
     if forwarded_from_id:
@@ -739,59 +2654,36 @@ def handle_send_message(data):
         ).fetchone()
         valid_forward = forwarded_from_id if fw_row else None
 
-    user = conn.execute("SELECT username FROM users WHERE id = ?", (me,)).fetchone()
-    cur = conn.execute(
-        """
-        INSERT INTO messages (
-          sender_id, recipient_id, content, image_url, media_url, media_type, file_name, file_size,
-          duration_sec, waveform_json, reply_to_id, forwarded_from_id, status, created_at
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            me,
-            recipient_id,
-            content,
-            image_url or None,
-            media_url or None,
-            media_type or None,
-            file_name[:255] if file_name else None,
-            file_size if file_size > 0 else None,
-            duration_sec if duration_sec > 0 else None,
-            json.dumps(waveform) if waveform else None,
-            valid_reply_to,
-            valid_forward,
-            status,
-            now_iso(),
-        ),
-    )
-    message_id = cur.lastrowid
-
-    msg_row = conn.execute(
-        """
-        SELECT m.id, m.sender_id, m.recipient_id, m.content, m.image_url, m.media_url, m.media_type,
-               m.file_name, m.file_size, m.duration_sec, m.waveform_json, m.reply_to_id,
-               m.forwarded_from_id, m.status, m.created_at, m.edited_at, m.deleted_at,
-               s.username AS sender_name,
-               rs.username AS reply_sender_name,
-               rm.content AS reply_content,
-               rm.image_url AS reply_image_url
-        FROM messages m
-        JOIN users s ON s.id = m.sender_id
-        LEFT JOIN messages rm ON rm.id = m.reply_to_id
-        LEFT JOIN users rs ON rs.id = rm.sender_id
-        WHERE m.id = ?
-        """,
-        (message_id,),
-    ).fetchall()
-
-    conn.commit()
-    payload = serialize_messages(conn, msg_row, me)[0]
-    payload["sender_name"] = user["username"] if user else "Unknown"
+    preview = load_previews(conn, [media_url]).get(media_url)
     conn.close()
 
-    emit("new_message", payload, room=f"user_{me}")
-    emit("new_message", payload, room=f"user_{recipient_id}")
+    user = user_cache.get(me)
+    record = {
+        "sender_id": int(me),
+        "recipient_id": recipient_id,
+        "content": content,
+        "image_url": image_url or None,
+        "media_url": media_url or None,
+        "media_type": media_type or None,
+        "file_name": file_name[:255] if file_name else None,
+        "file_size": file_size if file_size > 0 else None,
+        "duration_sec": duration_sec if duration_sec > 0 else None,
+        "waveform": waveform,
+        "reply_to_id": valid_reply_to,
+        "forwarded_from_id": valid_forward,
+        "status": status,
+        "created_at": now_iso(),
+        "preview": preview,
+    }
+
+    sender_name = user["username"] if user else "Unknown"
+
+    def deliver(conn, message_ids):
+        payload = build_message_payload(record, message_ids[0], sender_name, reply_row)
+        push_contact_updates(conn, [(me, recipient_id), (recipient_id, me)])
+        emit_to_users("new_message", payload, [me, recipient_id])
+
+    message_writer.submit([record], deliver)
 
 
 @socketio.on("edit_message")
@@ -806,7 +2698,7 @@ def handle_edit_message(data):
 
     conn = get_db()
     msg = conn.execute(
-        "SELECT id, sender_id, recipient_id, deleted_at FROM messages WHERE id = ?",
+        "SELECT id, sender_id, recipient_id, content, file_name, deleted_at FROM messages WHERE id = ?",
         (message_id,),
     ).fetchone()
     if not msg or int(msg["sender_id"]) != int(me) or msg["deleted_at"]:
@@ -818,7 +2710,12 @@ def handle_edit_message(data):
         "UPDATE messages SET content = ?, edited_at = ? WHERE id = ?",
         (content[:2000], edited_at, message_id),
     )
+    unindex_message(conn, message_id, msg["content"], msg["file_name"])
+    index_message(conn, message_id, content[:2000], msg["file_name"])
+    refresh_conversation(conn, msg["sender_id"], msg["recipient_id"])
+    refresh_conversation(conn, msg["recipient_id"], msg["sender_id"])
     conn.commit()
+    push_contact_updates(conn, [(msg["sender_id"], msg["recipient_id"]), (msg["recipient_id"], msg["sender_id"])])
     conn.close()
 
     emit(
@@ -880,6 +2777,9 @@ def handle_react_message(data):
         """,
         (message_id,),
     ).fetchall()
+    # Reactions are part of the history pages; move both sides' change_id so their ETags go stale.
+    touch_conversation(conn, msg["sender_id"], msg["recipient_id"])
+    touch_conversation(conn, msg["recipient_id"], msg["sender_id"])
     conn.commit()
     conn.close()
 
@@ -894,8 +2794,74 @@ def handle_react_message(data):
     ]
 
     payload = {"message_id": message_id, "reactions": reactions}
-    emit("message_reactions", payload, room=f"user_{msg['sender_id']}")
-    emit("message_reactions", payload, room=f"user_{msg['recipient_id']}")
+    emit_to_users("message_reactions", payload, [msg["sender_id"], msg["recipient_id"]])
+
+
+def message_ids_arg(data):
+    ids = (data or {}).get("message_ids") or []
+    if not isinstance(ids, list):
+        return []
+    return list(dict.fromkeys(int(i) for i in ids[:BULK_ACTION_MAX] if str(i).isdigit() and int(i) > 0))
+
+
+def load_messages_for_delete(conn, ids):
+    placeholders = ",".join(["?"] * len(ids))
+    return conn.execute(
+        f"""
+        SELECT id, sender_id, recipient_id, content, image_url, media_url, file_name, deleted_at
+        FROM messages WHERE id IN ({placeholders})
+        """,
+        ids,
+    ).fetchall()
+
+
+def hide_messages(conn, me, rows):
+    """Delete-for-me: hide rows `me` is party to and refresh the affected contact rows. Returns the hidden ids."""
+    rows = [r for r in rows if int(me) in (int(r["sender_id"]), int(r["recipient_id"]))]
+    if not rows:
+        return [], []
+    hidden_at = now_iso()
+    conn.executemany(
+        "INSERT OR IGNORE INTO message_hidden (message_id, user_id, created_at) VALUES (?, ?, ?)",
+        [(r["id"], me, hidden_at) for r in rows],
+    )
+    peers = {int(r["recipient_id"]) if int(r["sender_id"]) == int(me) else int(r["sender_id"]) for r in rows}
+    pairs = [(int(me), peer_id) for peer_id in peers]
+    for user_id, peer_id in pairs:
+        refresh_conversation(conn, user_id, peer_id)
+    return [r["id"] for r in rows], pairs
+
+
+def retract_messages(conn, me, rows):
+    """Delete-for-everyone: blank `me`'s own live messages, drop their media references and refresh both
+    sides' contact rows.
+
+    Returns the retracted rows and the (user, peer) pairs whose contact rows changed.
+    """
+    rows = [r for r in rows if int(r["sender_id"]) == int(me) and not r["deleted_at"]]
+    if not rows:
+        return [], []
+    deleted_at = now_iso()
+    conn.executemany(
+        """
+        UPDATE messages
+        SET content = '', image_url = NULL, media_url = NULL, media_type = NULL, file_name = NULL,
+            file_size = NULL, duration_sec = NULL, waveform = NULL, edited_at = NULL, deleted_at = ?
+        WHERE id = ?
+        """,
+        [(deleted_at, r["id"]) for r in rows],
+    )
+    for r in rows:
+        unindex_message(conn, r["id"], r["content"], r["file_name"])
+        release_media(conn, r["media_url"], r["image_url"])
+    conn.executemany("DELETE FROM message_reactions WHERE message_id = ?", [(r["id"],) for r in rows])
+    pairs = set()
+    for r in rows:
+        pairs.add((int(r["sender_id"]), int(r["recipient_id"])))
+        pairs.add((int(r["recipient_id"]), int(r["sender_id"])))
+    for user_id, peer_id in pairs:
+        refresh_conversation(conn, user_id, peer_id)
+    return rows, list(pairs)
 
 
 @socketio.on("delete_message")
@@ -907,47 +2873,129 @@ def handle_delete_message(data):
         return
 
     conn = get_db()
-    msg = conn.execute(
-        "SELECT id, sender_id, recipient_id, deleted_at FROM messages WHERE id = ?",
-        (msg_id,),
-    ).fetchone()
-    if not msg:
+    rows = load_messages_for_delete(conn, [msg_id])
+    if mode == "me":
+        _, pairs = hide_messages(conn, me, rows)
+    else:
+        rows, pairs = retract_messages(conn, me, rows)
+    if not pairs:
         conn.close()
         return
+    conn.commit()
+    push_contact_updates(conn, pairs)
+    if mode != "me":
+        collect_media(conn)
+    conn.close()
 
     if mode == "me":
-        if int(me) not in (int(msg["sender_id"]), int(msg["recipient_id"])):
-            conn.close()
-            return
-        conn.execute(
-            "INSERT OR IGNORE INTO message_hidden (message_id, user_id, created_at) VALUES (?, ?, ?)",
-            (msg_id, me, now_iso()),
-        )
-        conn.commit()
-        conn.close()
         emit("message_hidden", {"message_id": msg_id}, room=f"user_{me}")
         return
+    msg = rows[0]
+    emit("message_deleted", {"message_id": msg_id, "mode": "everyone"}, room=f"user_{msg['sender_id']}")
+    emit("message_deleted", {"message_id": msg_id, "mode": "everyone"}, room=f"user_{msg['recipient_id']}")
+
+
+@socketio.on("delete_messages")
+def handle_delete_messages(data):
+    """Multi-select delete: one query, one transaction, one messages_hidden/messages_deleted event per room."""
+    me = session.get("user_id")
+    ids = message_ids_arg(data)
+    mode = ((data or {}).get("mode") or "everyone").strip().lower()
+    if not me or not ids:
+        return
 
-    if int(msg["sender_id"]) != int(me) or msg["deleted_at"]:
+    conn = get_db()
+    rows = load_messages_for_delete(conn, ids)
+    if mode == "me":
+        hidden, pairs = hide_messages(conn, me, rows)
+    else:
+        rows, pairs = retract_messages(conn, me, rows)
+    if not pairs:
         conn.close()
         return
+    conn.commit()
+    push_contact_updates(conn, pairs)
+    if mode != "me":
+        collect_media(conn)
+    conn.close()
 
-    deleted_at = now_iso()
-    conn.execute(
-        """
-        UPDATE messages
-        SET content = '', image_url = NULL, media_url = NULL, media_type = NULL, file_name = NULL,
-            file_size = NULL, duration_sec = NULL, waveform_json = NULL, edited_at = NULL, deleted_at = ?
-        WHERE id = ?
+    if mode == "me":
+        emit("messages_hidden", {"message_ids": hidden}, room=f"user_{me}")
+        return
+    by_room = {}
+    for r in rows:
+        by_room.setdefault(int(r["sender_id"]), []).append(r["id"])
+        by_room.setdefault(int(r["recipient_id"]), []).append(r["id"])
+    for user_id, message_ids in by_room.items():
+        emit("messages_deleted", {"message_ids": message_ids, "mode": "everyone"}, room=f"user_{user_id}")
+
+
+@socketio.on("forward_messages")
+def handle_forward_messages(data):
+    """Forward several messages to one contact as a single writer batch and a single new_messages event."""
+    me = session.get("user_id")
+    ids = message_ids_arg(data)
+    recipient_id = int((data or {}).get("recipient_id") or 0)
+    if not me or not ids or not recipient_id:
+        return
+
+    conn = get_db()
+    if not can_access_pair(conn, me, recipient_id):
+        conn.close()
+        return
+    placeholders = ",".join(["?"] * len(ids))
+    rows = conn.execute(
+        f"""
+        SELECT id, content, image_url, media_url, media_type, file_name, file_size, duration_sec, waveform
+        FROM messages
+        WHERE id IN ({placeholders}) AND (sender_id = ? OR recipient_id = ?) AND deleted_at IS NULL
+        ORDER BY id ASC
         """,
-        (deleted_at, msg_id),
-    )
-    conn.execute("DELETE FROM message_reactions WHERE message_id = ?", (msg_id,))
-    conn.commit()
+        (*ids, me, me),
+    ).fetchall()
+    previews = load_previews(conn, [r["media_url"] or r["image_url"] for r in rows])
     conn.close()
 
-    emit("message_deleted", {"message_id": msg_id, "mode": "everyone"}, room=f"user_{msg['sender_id']}")
-    emit("message_deleted", {"message_id": msg_id, "mode": "everyone"}, room=f"user_{msg['recipient_id']}")
+    status = "delivered" if presence.is_online(recipient_id) else "sent"
+    created_at = now_iso()
+    records = [
+        {
+            "sender_id": int(me),
+            "recipient_id": recipient_id,
+            "content": r["content"] or "",
+            "image_url": r["image_url"],
+            "media_url": r["media_url"],
+            "media_type": r["media_type"],
+            "file_name": r["file_name"],
+            "file_size": r["file_size"],
+            "duration_sec": r["duration_sec"],
+            "waveform": r["waveform"],
+            "reply_to_id": None,
+            "forwarded_from_id": r["id"],
+            "status": status,
+            "created_at": created_at,
+            "preview": previews.get(r["media_url"] or r["image_url"]),
+        }
+        for r in rows
+        if r["content"] or r["image_url"] or r["media_url"]
+    ]
+    if not records:
+        return
+
+    user = user_cache.get(me)
+    sender_name = user["username"] if user else "Unknown"
+
+    def deliver(conn, message_ids):
+        payload = {
+            "messages": [
+                build_message_payload(record, message_id, sender_name)
+                for record, message_id in zip(records, message_ids)
+            ]
+        }
+        push_contact_updates(conn, [(me, recipient_id), (recipient_id, me)])
+        emit_to_users("new_messages", payload, [me, recipient_id])
+
+    message_writer.submit(records, deliver)
 
 
 def _emit_call_event(event_name, from_user_id, to_user_id, payload=None):
@@ -1028,7 +3076,11 @@ def handle_call_end(data):
     _emit_call_event("call_end", me, to_user_id, {"reason": reason})
 
 
-if __name__ == "__main__":
+# Spawned password-hashing workers re-import this file as __mp_main__ under `python app.py`; they need no DB.
+if __name__ != "__mp_main__":
     init_db()
+
+
+if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     socketio.run(app, host="0.0.0.0", port=port, debug=False)
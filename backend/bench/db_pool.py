@@ -0,0 +1,55 @@
+"""Per-event DB cost: a fresh sqlite3 connection per use (the old get_db) against the pooled get_db().
+
+Each event mirrors a send_message cycle: the session user lookup, an access-check read, and one committed write.
+
+    python backend/bench/db_pool.py [events]
+"""
+
+import sqlite3
+import sys
+import time
+
+from harness import load_app, signup, summary
+
+
+def fresh_connection(module):
+    def connect():
+        conn = sqlite3.connect(module.DB_PATH)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    return connect
+
+
+def event(get_db, user_id, peer_id, now):
+    conn = get_db()
+    conn.execute("SELECT id, username, email, avatar_url FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    conn = get_db()
+    conn.execute("SELECT id FROM users WHERE id = ?", (peer_id,)).fetchone()
+    conn.execute("UPDATE users SET last_seen = ? WHERE id = ?", (now, user_id))
+    conn.commit()
+    conn.close()
+
+
+def measure(get_db, user_id, peer_id, events):
+    samples = []
+    for _ in range(events):
+        start = time.perf_counter()
+        event(get_db, user_id, peer_id, time.time())
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main(events):
+    module = load_app(PASSWORD_HASH_WORKERS=0)
+    _, user_id = signup(module, "bench_a")
+    _, peer_id = signup(module, "bench_b")
+    for name, get_db in (("fresh connection", fresh_connection(module)), ("pooled get_db()", module.get_db)):
+        measure(get_db, user_id, peer_id, 50)
+        print(f"{name:18} {summary(measure(get_db, user_id, peer_id, events))}")
+    print("pool:", module.write_pool.stats())
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
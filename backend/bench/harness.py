@@ -0,0 +1,39 @@
+"""Shared setup for the bench scripts: import the app from a throwaway copy of the backend."""
+
+import importlib
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_app(**env):
+    """Import app.py from a temp copy with a fresh database, so benchmarks never touch the tracked one."""
+    root = Path(tempfile.mkdtemp(prefix="bench-"))
+    for name in ("app.py", "schema.sql", "password_hashing.py"):
+        shutil.copy(BACKEND_DIR / name, root / name)
+    shutil.copytree(BACKEND_DIR / "templates", root / "templates")
+    os.environ.update({key: str(value) for key, value in env.items()})
+    sys.path.insert(0, str(root))
+    module = importlib.import_module("app")
+    module.init_db()
+    return module
+
+
+def signup(module, name):
+    """Sign up `name` and return (logged-in test client, user id)."""
+    client = module.app.test_client()
+    response = client.post("/signup", data={"username": name, "email": f"{name}@example.com", "password": "secret123"})
+    assert response.status_code == 302, response.status_code
+    with client.session_transaction() as sess:
+        return client, sess["user_id"]
+
+
+def summary(samples_ms):
+    ordered = sorted(samples_ms)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"p50 {statistics.median(ordered):6.2f} ms  p95 {p95:6.2f} ms  max {ordered[-1]:6.2f} ms"
@@ -0,0 +1,71 @@
+"""send_message -> new_message latency while 8 threads hammer /login, with inline hashing and with the pool.
+
+    python backend/bench/login_storm.py            # both modes, each in its own process
+    python backend/bench/login_storm.py <workers>  # one mode (0 = inline)
+"""
+
+import subprocess
+import sys
+import threading
+import time
+
+from harness import load_app, signup, summary
+
+STORM_THREADS = 8
+
+
+def latencies(sender, recipient, recipient_id, count):
+    samples = []
+    for i in range(count):
+        recipient.get_received()
+        start = time.perf_counter()
+        sender.emit("send_message", {"recipient_id": recipient_id, "content": f"m{i}"})
+        while not any(e["name"] == "new_message" for e in recipient.get_received()):
+            time.sleep(0.0002)
+        samples.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.01)
+    return samples
+
+
+def run(workers):
+    module = load_app(PASSWORD_HASH_WORKERS=workers, PASSWORD_HASH_MAX_PENDING=64)
+    alice, _ = signup(module, "storm_alice")
+    bob, bob_id = signup(module, "storm_bob")
+    alice.post("/api/friends/add", json={"friend_id": bob_id})
+    sender = module.socketio.test_client(module.app, flask_test_client=alice)
+    recipient = module.socketio.test_client(module.app, flask_test_client=bob)
+
+    latencies(sender, recipient, bob_id, 5)
+    idle = latencies(sender, recipient, bob_id, 40)
+
+    stop = threading.Event()
+    logins = []
+
+    def storm():
+        client = module.app.test_client()
+        while not stop.is_set():
+            response = client.post("/login", data={"email": "storm_bob@example.com", "password": "secret123"})
+            logins.append(response.status_code)
+
+    threads = [threading.Thread(target=storm, daemon=True) for _ in range(STORM_THREADS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    started, before = time.perf_counter(), len(logins)
+    busy = latencies(sender, recipient, bob_id, 200)
+    rate = (len(logins) - before) / (time.perf_counter() - started)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    mode = "inline" if not workers else f"pool ({workers} workers)"
+    print(f"{mode:18} idle:  {summary(idle)}")
+    print(f"{mode:18} storm: {summary(busy)}  {rate:.1f} logins/s, statuses {sorted(set(logins))}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        for workers in (0, 2):
+            subprocess.run([sys.executable, __file__, str(workers)], check=True)
@@ -0,0 +1,60 @@
+"""Process-pool password hashing, kept free of app state so the spawned workers only need werkzeug."""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Hashes in a spawn process pool (inline when workers=0); past max_pending callers get HasherBusy."""
+
+    def __init__(self, method, workers, max_pending):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = 0
+        self.prefix = None
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise HasherBusy()
+            self.pending += 1
+            if self.pool is None:
+                # spawn: forking a process that already runs socket and writer threads is not safe.
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        pool = self.pool
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died (OOM kill, etc.); start a fresh pool on the next call instead of failing forever.
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            raise
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the stored hash was made with a different method or work factor than the configured one."""
+        if self.prefix is None:
+            self.prefix = self.hash("").split("$", 1)[0]
+        return password_hash.split("$", 1)[0] != self.prefix
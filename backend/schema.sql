@@ -3,6 +3,7 @@
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT NOT NULL UNIQUE,
+    username_lc TEXT,
     email TEXT NOT NULL UNIQUE,
     password_hash TEXT NOT NULL,
     avatar_url TEXT,
@@ -14,6 +15,7 @@ CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     sender_id INTEGER NOT NULL,
     recipient_id INTEGER NOT NULL,
+    conversation_id TEXT,
     content TEXT,
     image_url TEXT,
     media_url TEXT,
@@ -21,7 +23,7 @@ CREATE TABLE IF NOT EXISTS messages (
     file_name TEXT,
     file_size INTEGER,
     duration_sec REAL,
-    waveform_json TEXT,
+    waveform BLOB,
     reply_to_id INTEGER,
     forwarded_from_id INTEGER,
     status TEXT NOT NULL DEFAULT 'sent',
@@ -37,9 +39,6 @@ CREATE TABLE IF NOT EXISTS messages (
 CREATE INDEX IF NOT EXISTS idx_messages_pair_time
 ON messages (sender_id, recipient_id, created_at);
 
-CREATE INDEX IF NOT EXISTS idx_messages_recipient_status
-ON messages (recipient_id, status);
-
 CREATE TABLE IF NOT EXISTS message_reactions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     message_id INTEGER NOT NULL,
@@ -76,3 +75,74 @@ CREATE TABLE IF NOT EXISTS friends (
 
 CREATE INDEX IF NOT EXISTS idx_friends_user
 ON friends (user_id, friend_id);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER NOT NULL,
+    peer_id INTEGER NOT NULL,
+    last_message_id INTEGER,
+    last_message TEXT,
+    last_message_time TEXT,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    change_id INTEGER NOT NULL DEFAULT 0,
+    last_incoming_id INTEGER NOT NULL DEFAULT 0,
+    last_delivered_id INTEGER NOT NULL DEFAULT 0,
+    last_read_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, peer_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (peer_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS sync_counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS presence_sockets (
+    sid TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    worker_pid INTEGER NOT NULL,
+    connected_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_presence_sockets_user
+ON presence_sockets (user_id);
+
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS media_objects (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_media_objects_unreferenced ON media_objects (updated_at) WHERE ref_count = 0;
+
+CREATE TABLE IF NOT EXISTS media_previews (
+    sha256 TEXT PRIMARY KEY,
+    thumb_path TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    blurhash TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (sha256) REFERENCES media_objects(sha256) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS socketio_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
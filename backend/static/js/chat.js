@@ -1,7 +1,8 @@
 ﻿
 (() => {
   const me = window.APP_ME;
-  const socket = io();
+  // Offer the compact MessagePack wire format when the decoder loaded; the server falls back to JSON otherwise.
+  const socket = io({ auth: window.MessagePack ? { wire: 'msgpack' } : {} });
 
   const $ = (id) => document.getElementById(id);
   const contactsList = $('contactsList');
@@ -58,11 +59,16 @@
   const endCallBtnTop = $('endCallBtnTop');
 
   let contacts = [];
+  let contactsCursor = 0;
+  let searchHits = [];
+  let searchTimer = null;
   let activePeer = null;
   let typingTimer = null;
   let hasMore = true;
+  let hasNewer = false;
   let loadingHistory = false;
-  let oldestMessageId = null;
+  let olderCursor = null;
+  let newerCursor = null;
   let replyTarget = null;
   let selectionMode = false;
   let mediaDraft = null;
@@ -227,8 +233,11 @@
     const mediaType = msg.media_type || (msg.image_url ? 'image' : '');
     const mediaUrl = msg.media_url || msg.image_url;
     if (!mediaType || !mediaUrl || msg.deleted_at) return '';
-    if (mediaType === 'image') return `<img class="chat-image" data-lightbox="1" src="${esc(mediaUrl)}" alt="Image">`;
-    if (mediaType === 'video') return `<video controls preload="metadata" src="${esc(mediaUrl)}"></video>`;
+    const size = msg.width && msg.height ? ` width="${msg.width}" height="${msg.height}"` : '';
+    if (mediaType === 'image') return `<img class="chat-image" data-lightbox="1" data-full="${esc(mediaUrl)}" src="${esc(msg.thumb_url || mediaUrl)}"${size} loading="lazy" alt="Image">`;
+    if (mediaType === 'video') return msg.thumb_url
+      ? `<video controls preload="none" poster="${esc(msg.thumb_url)}"${size} src="${esc(mediaUrl)}"></video>`
+      : `<video controls preload="metadata" src="${esc(mediaUrl)}"></video>`;
     if (mediaType === 'voice' || mediaType === 'audio') return `<div class="voice-wrap">${renderWaveformBars(msg.waveform)}<audio controls src="${esc(mediaUrl)}"></audio><div class="muted">${fmtDuration(msg.duration_sec || 0)}</div></div>`;
     return `<div class="file-card"><div><strong>${esc(msg.file_name || 'Document')}</strong><div class="muted">${humanBytes(msg.file_size || 0)}</div></div><a class="download-btn" href="${esc(mediaUrl)}" download="${esc(msg.file_name || 'file')}">Download</a></div>`;
   }
@@ -248,8 +257,9 @@
     on('.react-btn', (e) => { e.stopPropagation(); node.querySelector('.reaction-picker').classList.toggle('hidden'); });
     node.querySelectorAll('.reaction-pick').forEach((b) => b.addEventListener('click', (e) => { e.stopPropagation(); socket.emit('react_message', { message_id: msg.id, emoji: b.dataset.emoji }); node.querySelector('.reaction-picker').classList.add('hidden'); }));
     node.querySelectorAll('.reaction-chip').forEach((chip) => chip.addEventListener('click', (e) => { e.stopPropagation(); socket.emit('react_message', { message_id: msg.id, emoji: chip.dataset.emoji }); }));
-    node.querySelectorAll('[data-lightbox="1"]').forEach((img) => img.addEventListener('click', (e) => { e.stopPropagation(); lightboxImg.src = img.src; lightbox.classList.remove('hidden'); }));
+    node.querySelectorAll('[data-lightbox="1"]').forEach((img) => img.addEventListener('click', (e) => { e.stopPropagation(); lightboxImg.src = img.dataset.full || img.src; lightbox.classList.remove('hidden'); }));
     on('.reply-btn', (e) => { e.stopPropagation(); setReplyTarget(msg); });
+    on('.reply-snippet', (e) => { e.stopPropagation(); jumpToMessage(msg.reply_to_id); });
     on('.edit-btn', (e) => { e.stopPropagation(); const updated = prompt('Edit message', msg.content || ''); if (updated && updated.trim()) socket.emit('edit_message', { message_id: msg.id, content: updated.trim() }); });
     on('.forward-btn', (e) => {
       e.stopPropagation(); if (!activePeer) return;
@@ -305,61 +315,189 @@
 
   function scrollBottom() { messagesEl.scrollTop = messagesEl.scrollHeight; }
 
-  async function loadContacts() {
-    const res = await fetch('/api/contacts');
-    contacts = await res.json();
+  function renderContacts() {
     const q = chatSearch.value.toLowerCase().trim();
     const html = contacts.filter((c) => c.username.toLowerCase().includes(q) || (c.last_message || '').toLowerCase().includes(q)).map((c) => {
       const statusClass = c.is_online ? 'online' : 'offline';
       const activeClass = activePeer && activePeer.id === c.id ? 'active' : '';
       return `<article class="contact ${activeClass}" data-id="${c.id}"><img src="${esc(c.avatar_url || '')}" class="avatar" alt="${esc(c.username)}"><div><h4>${esc(c.username)}</h4><p>${esc(c.last_message || 'Start chatting...')}</p></div><div><small class="status-dot ${statusClass}">${esc(statusText(c))}</small>${c.unread_count > 0 ? `<div class="badge">${c.unread_count}</div>` : ''}</div></article>`;
     }).join('');
-    contactsList.innerHTML = html || '<p class="muted">No chats found</p>';
-    contactsList.querySelectorAll('.contact').forEach((el) => el.addEventListener('click', () => openChat(Number(el.dataset.id))));
+    const hits = searchHits.map((h) => {
+      const peer = contacts.find((c) => c.id === h.peer_id);
+      const text = esc(h.snippet || h.file_name || '').replace(/\u0002/g, '<mark>').replace(/\u0003/g, '</mark>');
+      return `<article class="contact search-hit" data-id="${h.peer_id}" data-message="${h.id}"><div><h4>${esc(peer ? peer.username : h.sender_name)}</h4><p>${text}</p></div><small>${esc(new Date(h.created_at).toLocaleDateString())}</small></article>`;
+    }).join('');
+    contactsList.innerHTML = (html || '<p class="muted">No chats found</p>') + hits;
+    contactsList.querySelectorAll('.contact').forEach((el) => el.addEventListener('click', async () => {
+      const peerId = Number(el.dataset.id);
+      if (!el.dataset.message) { openChat(peerId); return; }
+      if (!activePeer || activePeer.id !== peerId) await openChat(peerId);
+      jumpToMessage(Number(el.dataset.message));
+    }));
     if (!activePeer && contacts.length) openChat(contacts[0].id);
   }
 
-  async function fetchMessages({ beforeId = null, prepend = false } = {}) {
+  function applyContactUpdate(update) {
+    if (!update || typeof update.id !== 'number') return;
+    contactsCursor = Math.max(contactsCursor, update.change_id || 0);
+    contacts = contacts.filter((c) => c.id !== update.id);
+    if (!update.removed) {
+      contacts.push(update);
+      contacts.sort((a, b) => String(b.sort_time || '').localeCompare(String(a.sort_time || '')));
+      if (activePeer && activePeer.id === update.id) activePeer = update;
+    }
+    renderContacts();
+  }
+
+  function searchMessages() {
+    clearTimeout(searchTimer);
+    const q = chatSearch.value.trim();
+    if (q.length < 2) {
+      searchHits = [];
+      renderContacts();
+      return;
+    }
+    searchTimer = setTimeout(async () => {
+      try {
+        const res = await fetch(`/api/search?${new URLSearchParams({ q })}`);
+        const data = await res.json();
+        if (chatSearch.value.trim() === q) searchHits = data.results || [];
+      } catch (_) {
+        searchHits = [];
+      }
+      renderContacts();
+    }, 250);
+  }
+
+  async function loadContacts() {
+    const res = await fetch('/api/contacts');
+    contacts = await res.json();
+    contactsCursor = Number(res.headers.get('X-Contacts-Cursor') || 0);
+    renderContacts();
+  }
+
+  async function syncContacts() {
+    try {
+      const res = await fetch(`/api/contacts?since=${contactsCursor}`);
+      const delta = await res.json();
+      (delta.removed || []).forEach((id) => applyContactUpdate({ id, removed: true }));
+      (delta.contacts || []).forEach(applyContactUpdate);
+      contactsCursor = Math.max(contactsCursor, delta.cursor || 0);
+    } catch (_) {}
+  }
+
+  async function fetchHistory(params) {
+    try {
+      const res = await fetch(`/api/messages/${activePeer.id}?${params}`);
+      if (res.ok) return await res.json();
+    } catch (_) {}
+    return null;
+  }
+
+  function resetTimeline(messages) {
+    messagesEl.innerHTML = '';
+    messageStore.clear();
+    messages.forEach((m) => renderOrUpdateMessage(m, true, false));
+  }
+
+  // Each history page carries opaque cursors for the rows just past its oldest and newest message.
+  function applyPage(data, { older = true, newer = true } = {}) {
+    if (older) { hasMore = !!data.has_older; olderCursor = data.before || olderCursor; }
+    if (newer) { hasNewer = !!data.has_newer; newerCursor = data.after || newerCursor; }
+  }
+
+  async function fetchMessages({ prepend = false } = {}) {
     if (!activePeer || loadingHistory || (!hasMore && prepend)) return;
     loadingHistory = true;
     if (!prepend) showMessageSkeleton();
     const params = new URLSearchParams({ limit: '25' });
-    if (beforeId) params.set('before_id', String(beforeId));
-    let data = { messages: [], has_more: false };
-    try {
-      const res = await fetch(`/api/messages/${activePeer.id}?${params}`);
-      data = await res.json();
-    } catch (_) {
-      data = { messages: getCachedMessages(activePeer.id), has_more: false };
-    }
+    if (prepend && olderCursor) params.set('before', olderCursor);
+    const data = await fetchHistory(params) || { messages: prepend ? [] : getCachedMessages(activePeer.id), has_older: false, has_newer: false };
     const messages = data.messages || [];
-    if (!prepend) { messagesEl.innerHTML = ''; messageStore.clear(); }
     const prevHeight = messagesEl.scrollHeight;
     if (prepend) {
-      for (let i = messages.length - 1; i >= 0; i -= 1) {
-        const m = messages[i];
-        renderOrUpdateMessage(m, false, true);
-        oldestMessageId = oldestMessageId === null ? m.id : Math.min(oldestMessageId, m.id);
-      }
+      for (let i = messages.length - 1; i >= 0; i -= 1) renderOrUpdateMessage(messages[i], false, true);
+      applyPage(data, { newer: false });
+      messagesEl.scrollTop = messagesEl.scrollHeight - prevHeight;
     } else {
-      messages.forEach((m) => {
-        renderOrUpdateMessage(m, true, false);
-        oldestMessageId = oldestMessageId === null ? m.id : Math.min(oldestMessageId, m.id);
-      });
+      olderCursor = null;
+      newerCursor = null;
+      resetTimeline(messages);
+      applyPage(data);
+      cacheMessages(activePeer.id, messages);
+      scrollBottom();
+    }
+    loadingHistory = false;
+  }
+
+  async function fetchNewer() {
+    if (!activePeer || loadingHistory || !hasNewer || !newerCursor) return;
+    loadingHistory = true;
+    const data = await fetchHistory(new URLSearchParams({ limit: '25', after: newerCursor }));
+    if (data) {
+      (data.messages || []).forEach((m) => renderOrUpdateMessage(m));
+      applyPage(data, { older: false });
+      if (!hasNewer) markRead();
     }
-    hasMore = !!data.has_more;
-    if (!prepend) cacheMessages(activePeer.id, messages);
-    if (prepend) messagesEl.scrollTop = messagesEl.scrollHeight - prevHeight; else scrollBottom();
     loadingHistory = false;
   }
 
+  function flashMessage(node) {
+    node.scrollIntoView({ block: 'center' });
+    node.classList.remove('jump-target');
+    void node.offsetWidth;
+    node.classList.add('jump-target');
+  }
+
+  // Reply previews and search hits can point outside the loaded pages; load the window around the target.
+  async function jumpToMessage(messageId) {
+    if (!activePeer || !messageId) return;
+    const existing = messagesEl.querySelector(`.message[data-id="${messageId}"]`);
+    if (existing) { flashMessage(existing); return; }
+    if (loadingHistory) return;
+    loadingHistory = true;
+    const data = await fetchHistory(new URLSearchParams({ limit: '25', around: String(messageId) }));
+    if (data) {
+      olderCursor = null;
+      newerCursor = null;
+      resetTimeline(data.messages || []);
+      applyPage(data);
+    }
+    loadingHistory = false;
+    const node = messagesEl.querySelector(`.message[data-id="${messageId}"]`);
+    if (node) flashMessage(node);
+  }
+
+  // After a reconnect, fetch only what arrived while the socket was down.
+  async function catchUp() {
+    if (!activePeer || hasNewer || loadingHistory) return;
+    let newest = 0;
+    messageStore.forEach((_, id) => { if (id > newest) newest = id; });
+    if (!newest) { fetchMessages(); return; }
+    loadingHistory = true;
+    let params = new URLSearchParams({ limit: '100', after_id: String(newest) });
+    for (;;) {
+      const data = await fetchHistory(params);
+      if (!data) break;
+      (data.messages || []).forEach((m) => renderOrUpdateMessage(m));
+      newerCursor = data.after || newerCursor;
+      if (!data.has_newer) break;
+      params = new URLSearchParams({ limit: '100', after: data.after });
+    }
+    loadingHistory = false;
+    scrollBottom();
+    markRead();
+  }
+
   async function openChat(peerId) {
     const peer = contacts.find((c) => c.id === peerId);
     if (!peer) return;
     activePeer = peer;
     hasMore = true;
+    hasNewer = false;
     loadingHistory = false;
-    oldestMessageId = null;
+    olderCursor = null;
+    newerCursor = null;
     setReplyTarget(null);
     setSelectionMode(false);
     setMediaDraft(null);
@@ -371,7 +509,15 @@
     if (window.innerWidth <= 900) appShell.classList.add('mobile-chat-focus');
     socket.emit('join_chat', { peer_id: peerId });
     await fetchMessages();
-    loadContacts();
+    markRead();
+    renderContacts();
+  }
+
+  function markRead() {
+    if (!activePeer) return;
+    let upTo = 0;
+    messageStore.forEach((msg, id) => { if (msg.sender_id === activePeer.id && id > upTo) upTo = id; });
+    if (upTo) socket.emit('mark_read', { peer_id: activePeer.id, up_to_id: upTo });
   }
 
   async function uploadAvatar(file) {
@@ -383,7 +529,55 @@
     return data;
   }
 
+  const UPLOAD_CHUNK = 4 * 1024 * 1024;
+
+  async function uploadOffset(uploadId) {
+    const res = await fetch(`/upload/media/${uploadId}`, { cache: 'no-store' });
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || 'Upload failed');
+    return data.offset;
+  }
+
+  // Large files go up in raw chunks; after a dropped connection we ask the server for its offset and carry on from there.
+  async function uploadResumable(file, mediaType) {
+    const init = await fetch('/upload/media/init', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ file_name: file.name, file_size: file.size, media_type: mediaType }),
+    });
+    const started = await init.json();
+    if (!init.ok) throw new Error(started.error || 'Upload failed');
+    const chunkSize = started.chunk_size || UPLOAD_CHUNK;
+    let offset = 0;
+    let failures = 0;
+    while (offset < file.size) {
+      try {
+        const res = await fetch(`/upload/media/${started.upload_id}`, {
+          method: 'PATCH',
+          headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/offset+octet-stream' },
+          body: file.slice(offset, offset + chunkSize),
+        });
+        const data = await res.json();
+        if (res.status === 404 || res.status === 401) throw new Error(data.error || 'Upload failed');
+        if (!res.ok) throw new Error('retry');
+        offset = data.offset;
+        failures = 0;
+      } catch (err) {
+        if (err.message !== 'retry' && !(err instanceof TypeError)) throw err;
+        failures += 1;
+        if (failures > 5) throw new Error('Upload interrupted');
+        await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** failures));
+        offset = await uploadOffset(started.upload_id).catch(() => offset);
+      }
+    }
+    const res = await fetch(`/upload/media/${started.upload_id}/finalize`, { method: 'POST' });
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || 'Upload failed');
+    return data;
+  }
+
   async function uploadMedia(file, mediaType = '') {
+    if (file.size > UPLOAD_CHUNK) return uploadResumable(file, mediaType);
     const fd = new FormData();
     fd.append('media', file);
     if (mediaType) fd.append('media_type', mediaType);
@@ -633,31 +827,77 @@
     resetCallState();
   }
 
-  socket.on('new_message', (msg) => {
-    const belongs = activePeer && [msg.sender_id, msg.recipient_id].includes(activePeer.id);
-    if (belongs) {
-      renderOrUpdateMessage(msg);
-      scrollBottom();
-      oldestMessageId = oldestMessageId === null ? msg.id : Math.min(oldestMessageId, msg.id);
-      if (msg.sender_id === activePeer.id) socket.emit('join_chat', { peer_id: activePeer.id });
-    }
-    if (msg.sender_id !== me.id) {
+  function receiveMessages(list) {
+    let fromActivePeer = false;
+    let incoming = null;
+    let sentWhileDetached = false;
+    list.forEach((msg) => {
+      const belongs = activePeer && [msg.sender_id, msg.recipient_id].includes(activePeer.id);
+      // While an older window is on screen, new messages are picked up by scrolling down instead.
+      if (belongs && hasNewer) sentWhileDetached = sentWhileDetached || msg.sender_id === me.id;
+      else if (belongs) {
+        renderOrUpdateMessage(msg);
+        if (msg.sender_id === activePeer.id) fromActivePeer = true;
+      }
+      if (msg.sender_id !== me.id) incoming = msg;
+    });
+    if (sentWhileDetached) fetchMessages();
+    else if (!hasNewer) scrollBottom();
+    if (fromActivePeer) markRead();
+    if (incoming) {
       playNotify();
       if (document.hidden) {
-        notifyFromSW(msg.sender_name || 'New message', msg.content || msg.file_name || 'Sent you a media message');
+        notifyFromSW(incoming.sender_name || 'New message', incoming.content || incoming.file_name || 'Sent you a media message');
       }
     }
-    loadContacts();
-  });
+  }
 
-  socket.on('message_status', ({ message_ids, status }) => {
-    (message_ids || []).forEach((id) => {
-      const msg = messageStore.get(id); if (!msg) return;
+  const MESSAGE_WIRE_KEYS = { i: 'id', s: 'sender_id', r: 'recipient_id', c: 'content', iu: 'image_url', mu: 'media_url', mt: 'media_type', fn: 'file_name', fs: 'file_size', d: 'duration_sec', rt: 'reply_to_id', f: 'forwarded_from_id', st: 'status', t: 'created_at', e: 'edited_at', x: 'deleted_at', n: 'sender_name', tu: 'thumb_url', pw: 'width', ph: 'height', bh: 'blurhash' };
+
+  const expandReactions = (rx) => (rx || []).map(([user_id, username, emoji]) => ({ user_id, username, emoji, is_me: user_id === me.id }));
+
+  function expandMessage(m) {
+    const msg = {};
+    Object.entries(MESSAGE_WIRE_KEYS).forEach(([short, key]) => { msg[key] = m[short] ?? null; });
+    if (msg.content === null) msg.content = '';
+    msg.waveform = m.w ? Array.from(m.w) : [];
+    msg.reactions = expandReactions(m.rx);
+    msg.is_forwarded = !!msg.forwarded_from_id;
+    const rp = m.rp;
+    msg.reply_sender_name = rp ? rp.n ?? null : null;
+    msg.reply_content = rp ? rp.c ?? null : null;
+    msg.reply_image_url = rp ? rp.u ?? null : null;
+    msg.reply_preview = rp ? { id: msg.reply_to_id, sender_name: msg.reply_sender_name, content: msg.reply_content, image_url: msg.reply_image_url } : null;
+    return msg;
+  }
+
+  const WIRE_DECODERS = {
+    new_message: expandMessage,
+    new_messages: (d) => ({ messages: (d.m || []).map(expandMessage) }),
+    read_up_to: (d) => ({ peer_id: d.p, delivered_up_to: d.d || 0, read_up_to: d.r || 0 }),
+    presence_batch: (d) => ({ presence: (d.p || []).map(([user_id, device_count, last_seen]) => ({ user_id, device_count, last_seen, is_online: device_count > 0, status: device_count > 0 ? 'online' : 'offline' })) }),
+    message_reactions: (d) => ({ message_id: d.m, reactions: expandReactions(d.rx) }),
+  };
+
+  // Events the server may send MessagePack-framed; decode them back into the JSON shape the handlers expect.
+  function onWire(event, handler) {
+    socket.on(event, (data) => handler(data instanceof ArrayBuffer || ArrayBuffer.isView(data) ? WIRE_DECODERS[event](MessagePack.decode(data)) : data));
+  }
+
+  onWire('new_message', (msg) => receiveMessages([msg]));
+  onWire('new_messages', ({ messages }) => receiveMessages(messages || []));
+
+  onWire('read_up_to', ({ peer_id, read_up_to = 0, delivered_up_to = 0 }) => {
+    messageStore.forEach((msg, id) => {
+      if (msg.sender_id !== me.id || msg.recipient_id !== peer_id) return;
+      let status = msg.status;
+      if (id <= read_up_to) status = 'seen';
+      else if (id <= delivered_up_to && status === 'sent') status = 'delivered';
+      if (status === msg.status) return;
       msg.status = status;
       const tick = messagesEl.querySelector(`.message[data-id="${id}"] .ticks`);
       if (tick) { tick.dataset.status = status; tick.className = `ticks ${tickClass(status)}`; tick.textContent = tickSymbol(status); }
     });
-    loadContacts();
   });
 
   socket.on('message_edited', ({ message_id, content, edited_at }) => {
@@ -665,28 +905,43 @@
     msg.content = content; msg.edited_at = edited_at; renderOrUpdateMessage(msg, false, false);
   });
 
-  socket.on('message_reactions', ({ message_id, reactions }) => {
+  onWire('message_reactions', ({ message_id, reactions }) => {
     const msg = messageStore.get(message_id); if (!msg) return;
     msg.reactions = reactions || []; renderOrUpdateMessage(msg, false, false);
   });
 
-  socket.on('message_deleted', ({ message_id }) => {
-    const msg = messageStore.get(message_id); if (!msg) return;
+  function chunked(list, size) {
+    const out = [];
+    for (let i = 0; i < list.length; i += size) out.push(list.slice(i, i + size));
+    return out;
+  }
+
+  function markDeleted(messageId) {
+    const msg = messageStore.get(messageId); if (!msg) return;
     Object.assign(msg, { content: '', image_url: null, media_url: null, media_type: null, file_name: null, file_size: null, duration_sec: null, waveform: [], deleted_at: new Date().toISOString(), reactions: [], edited_at: null });
     renderOrUpdateMessage(msg, false, false);
-    loadContacts();
-  });
+  }
 
-  socket.on('message_hidden', ({ message_id }) => {
-    messageStore.delete(message_id);
-    const el = messagesEl.querySelector(`.message[data-id="${message_id}"]`);
+  function removeHidden(messageId) {
+    messageStore.delete(messageId);
+    const el = messagesEl.querySelector(`.message[data-id="${messageId}"]`);
     if (el) el.remove();
-    selectedMessageIds.delete(message_id);
+    selectedMessageIds.delete(messageId);
+  }
+
+  socket.on('message_deleted', ({ message_id }) => markDeleted(message_id));
+  socket.on('messages_deleted', ({ message_ids }) => (message_ids || []).forEach(markDeleted));
+
+  socket.on('message_hidden', ({ message_id }) => {
+    removeHidden(message_id);
+    selectionCount.textContent = `${selectedMessageIds.size} selected`;
+  });
+  socket.on('messages_hidden', ({ message_ids }) => {
+    (message_ids || []).forEach(removeHidden);
     selectionCount.textContent = `${selectedMessageIds.size} selected`;
-    loadContacts();
   });
 
-  socket.on('presence', ({ user_id, status, is_online, last_seen, device_count }) => {
+  function applyPresence({ user_id, status, is_online, last_seen, device_count }) {
     const online = typeof is_online === 'boolean' ? is_online : status === 'online';
     contacts = contacts.map((c) => (c.id === user_id ? { ...c, is_online: online, last_seen: last_seen || c.last_seen, device_count: device_count ?? c.device_count } : c));
     if (activePeer && activePeer.id === user_id) {
@@ -696,9 +951,18 @@
       activeStatus.textContent = statusText(activePeer);
       activeStatus.className = `status-dot ${activePeer.is_online ? 'online' : 'offline'}`;
     }
-    loadContacts();
+  }
+
+  onWire('presence_batch', ({ presence }) => {
+    (presence || []).forEach(applyPresence);
+    renderContacts();
   });
 
+  socket.on('contact_updated', applyContactUpdate);
+  // Presence doesn't move change_id, so a ?since= delta would miss friends who came online meanwhile; the full list
+  // is validated by an ETag that covers online state, so an unchanged list costs a 304.
+  socket.io.on('reconnect', () => { loadContacts(); catchUp(); });
+
   socket.on('typing', ({ from_user_id, is_typing }) => {
     if (!activePeer || from_user_id !== activePeer.id) return;
     typingLabel.textContent = `${activePeer.username} is typing...`;
@@ -778,8 +1042,12 @@
   });
 
   messagesEl.addEventListener('scroll', async () => {
-    if (messagesEl.scrollTop > 60 || !hasMore || loadingHistory || !oldestMessageId) return;
-    await fetchMessages({ beforeId: oldestMessageId, prepend: true });
+    if (hasNewer && messagesEl.scrollHeight - messagesEl.scrollTop - messagesEl.clientHeight < 60) {
+      await fetchNewer();
+      return;
+    }
+    if (messagesEl.scrollTop > 60 || !hasMore || loadingHistory || !olderCursor) return;
+    await fetchMessages({ prepend: true });
   });
 
   sendBtn.addEventListener('click', sendMessage);
@@ -839,10 +1107,7 @@
 
   forwardSelectedBtn.addEventListener('click', () => {
     if (!activePeer || !selectedMessageIds.size) return;
-    [...selectedMessageIds].forEach((id) => {
-      const msg = messageStore.get(id); if (!msg) return;
-      socket.emit('send_message', { recipient_id: activePeer.id, content: msg.content || '', image_url: msg.image_url || '', media_url: msg.media_url || '', media_type: msg.media_type || '', file_name: msg.file_name || '', file_size: msg.file_size || 0, duration_sec: msg.duration_sec || 0, waveform: msg.waveform || [], forwarded_from_id: msg.id });
-    });
+    chunked([...selectedMessageIds], 100).forEach((ids) => socket.emit('forward_messages', { recipient_id: activePeer.id, message_ids: ids }));
     setSelectionMode(false);
   });
 
@@ -850,13 +1115,13 @@
     if (!selectedMessageIds.size) return;
     const mode = (prompt('Delete selected: type "me" or "everyone"', 'me') || '').toLowerCase();
     if (mode !== 'me' && mode !== 'everyone') return;
-    [...selectedMessageIds].forEach((id) => socket.emit('delete_message', { message_id: id, mode }));
+    chunked([...selectedMessageIds], 100).forEach((ids) => socket.emit('delete_messages', { message_ids: ids, mode }));
     setSelectionMode(false);
   });
 
   clearSelectionBtn.addEventListener('click', () => setSelectionMode(false));
   emojiBtn.addEventListener('click', () => emojiPicker.classList.toggle('hidden'));
-  chatSearch.addEventListener('input', loadContacts);
+  chatSearch.addEventListener('input', () => { renderContacts(); searchMessages(); });
   lightboxClose.addEventListener('click', () => lightbox.classList.add('hidden'));
   lightbox.addEventListener('click', (e) => { if (e.target === lightbox) lightbox.classList.add('hidden'); });
 
@@ -930,7 +1195,7 @@
       return;
     }
     friendSearch.value = '';
-    loadContacts();
+    syncContacts();
   }
 
   friendAddBtn.addEventListener('click', addFriend);
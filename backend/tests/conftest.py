@@ -0,0 +1,48 @@
+"""Shared fixtures: the app is imported once per session from a throwaway copy of the backend."""
+
+import importlib
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def chat_app(tmp_path_factory):
+    # Run against a copy of the backend so the tracked database and uploads are never touched.
+    root = tmp_path_factory.mktemp("backend")
+    for name in ("app.py", "schema.sql", "password_hashing.py"):
+        if (BACKEND_DIR / name).exists():
+            shutil.copy(BACKEND_DIR / name, root / name)
+    shutil.copytree(BACKEND_DIR / "templates", root / "templates")
+    os.environ["PASSWORD_HASH_WORKERS"] = "0"
+    os.environ["PREVIEW_WORKERS"] = "0"
+    sys.path.insert(0, str(root))
+    sys.modules.pop("app", None)
+    try:
+        module = importlib.import_module("app")
+        module.init_db()
+        yield module
+    finally:
+        sys.path.remove(str(root))
+        sys.modules.pop("app", None)
+
+
+@pytest.fixture
+def signup(chat_app):
+    """signup(name) -> (logged-in test client, user id)."""
+
+    def make(name):
+        client = chat_app.app.test_client()
+        response = client.post(
+            "/signup", data={"username": name, "email": f"{name}@example.com", "password": "secret123"}
+        )
+        assert response.status_code == 302
+        with client.session_transaction() as sess:
+            return client, sess["user_id"]
+
+    return make
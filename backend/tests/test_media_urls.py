@@ -0,0 +1,18 @@
+"""Signed /media links: anything malformed is a 403, never a server error."""
+
+import io
+
+
+def test_malformed_signature_is_forbidden(chat_app, signup):
+    client, _ = signup("frank")
+    response = client.post(
+        "/upload/media", data={"media": (io.BytesIO(b"abc"), "b.pdf")}, content_type="multipart/form-data"
+    )
+    path, _, query = response.get_json()["media_url"].partition("?")
+    exp = query.split("&")[0]
+
+    assert client.get(f"{path}?{query}").status_code == 200
+    assert client.get(f"{path}?{exp}&sig=%C3%A9").status_code == 403
+    assert client.get(f"{path}?exp=%C2%B2&sig=x").status_code == 403
+    assert chat_app.canonical_media_url(f"{path}?{exp}&sig=é") == ""
+    assert chat_app.canonical_media_url(f"{path}?exp=²&sig=x") == ""
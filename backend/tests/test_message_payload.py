@@ -0,0 +1,72 @@
+"""The live new_message/new_messages payloads must match what /api/messages returns for the same rows."""
+
+import io
+import time
+
+
+def upload(client, filename, data, media_type):
+    response = client.post(
+        "/upload/media",
+        data={"media": (io.BytesIO(data), filename), "media_type": media_type},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def received(socket_client, name):
+    # Delivery runs on the writer's delivery thread, so give it a moment to emit.
+    for _ in range(50):
+        events = [e["args"][0] for e in socket_client.get_received() if e["name"] == name]
+        if events:
+            return events
+        time.sleep(0.02)
+    raise AssertionError(f"no {name} event")
+
+
+def history(client, peer_id):
+    return {m["id"]: m for m in client.get(f"/api/messages/{peer_id}?limit=100").get_json()["messages"]}
+
+
+def test_live_payload_matches_history(chat_app, signup):
+    alice, alice_id = signup("alice")
+    bob, bob_id = signup("bob")
+    assert alice.post("/api/friends/add", json={"friend_id": bob_id}).status_code == 200
+    sock = chat_app.socketio.test_client(chat_app.app, flask_test_client=alice)
+    sock.get_received()
+
+    image = upload(alice, "photo.png", b"\x89PNG\r\n\x1a\n" + b"\0" * 64, "image")
+    voice = upload(alice, "note.webm", b"\x1aE\xdf\xa3" + b"\0" * 64, "voice")
+
+    live = []
+    sock.emit("send_message", {"recipient_id": bob_id, "content": "hello"})
+    text = received(sock, "new_message")[0]
+    live.append(text)
+    sock.emit("send_message", {"recipient_id": bob_id, "content": "re", "reply_to_id": text["id"]})
+    live += received(sock, "new_message")
+    sock.emit(
+        "send_message",
+        {"recipient_id": bob_id, "media_url": image["media_url"], "media_type": "image", "file_name": "photo.png"},
+    )
+    live += received(sock, "new_message")
+    sock.emit(
+        "send_message",
+        {
+            "recipient_id": bob_id,
+            "media_url": voice["media_url"],
+            "media_type": "voice",
+            "duration_sec": 1.5,
+            "waveform": [0, 64, 255],
+        },
+    )
+    live += received(sock, "new_message")
+    sock.emit("forward_messages", {"message_ids": [m["id"] for m in live], "recipient_id": bob_id})
+    live += received(sock, "new_messages")[0]["messages"]
+    sock.disconnect()
+
+    assert live[1]["reply_preview"]["id"] == text["id"]
+    assert live[3]["waveform"] == [0, 64, 255]
+    assert all(m["is_forwarded"] for m in live[4:])
+    stored = history(alice, bob_id)
+    for message in live:
+        assert message == stored[message["id"]]
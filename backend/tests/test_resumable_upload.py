@@ -0,0 +1,77 @@
+"""Resumable uploads driven the way chat.js does it: init, PATCH chunks at offsets, resume, finalize."""
+
+import os
+
+
+def patch(client, upload_id, offset, body, **environ):
+    return client.patch(
+        f"/upload/media/{upload_id}",
+        data=body,
+        headers={"Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream"},
+        environ_overrides=environ,
+    )
+
+
+def test_resume_after_truncated_chunk(chat_app, signup):
+    client, _ = signup("carol")
+    data = os.urandom(300 * 1024)
+    init = client.post("/upload/media/init", json={"file_name": "clip.mp4", "file_size": len(data)})
+    assert init.status_code == 201
+    upload_id = init.get_json()["upload_id"]
+
+    # The connection drops 100 KB into a 200 KB chunk; what arrived is kept.
+    cut = 100 * 1024
+    response = patch(client, upload_id, 0, data[:cut], CONTENT_LENGTH=str(2 * cut))
+    assert response.status_code == 400
+    assert response.get_json()["offset"] == cut
+
+    response = client.get(f"/upload/media/{upload_id}")
+    assert response.get_json()["offset"] == cut
+    assert response.headers["Upload-Offset"] == str(cut)
+
+    response = patch(client, upload_id, 0, data[:cut])
+    assert response.status_code == 409
+    assert response.get_json()["offset"] == cut
+
+    response = client.post(f"/upload/media/{upload_id}/finalize")
+    assert response.status_code == 409
+    assert response.get_json()["offset"] == cut
+
+    response = patch(client, upload_id, cut, data[cut:])
+    assert response.status_code == 200
+    assert response.get_json()["offset"] == len(data)
+
+    response = client.post(f"/upload/media/{upload_id}/finalize")
+    assert response.status_code == 200
+    media = client.get(response.get_json()["media_url"])
+    assert media.status_code == 200
+    assert media.data == data
+
+    assert client.post(f"/upload/media/{upload_id}/finalize").status_code == 404
+
+
+def test_finalize_waits_for_chunk_in_flight(chat_app, signup):
+    client, _ = signup("dave")
+    data = os.urandom(4096)
+    upload_id = client.post("/upload/media/init", json={"file_name": "a.pdf", "file_size": len(data)}).get_json()[
+        "upload_id"
+    ]
+    assert patch(client, upload_id, 0, data).status_code == 200
+
+    with chat_app.upload_locks_guard:
+        lock = chat_app.upload_locks.setdefault(upload_id, chat_app.threading.Lock())
+    with lock:
+        response = client.post(f"/upload/media/{upload_id}/finalize")
+    assert response.status_code == 409
+    assert client.post(f"/upload/media/{upload_id}/finalize").status_code == 200
+
+
+def test_rejects_bad_size_and_unknown_upload(chat_app, signup):
+    client, _ = signup("erin")
+    response = client.post("/upload/media/init", json={"file_name": "a.pdf", "file_size": "lots"})
+    assert response.status_code == 400
+
+    locks = len(chat_app.upload_locks)
+    assert patch(client, "0" * 32, 0, b"x").status_code == 404
+    assert client.post(f"/upload/media/{'0' * 32}/finalize").status_code == 404
+    assert len(chat_app.upload_locks) == locks
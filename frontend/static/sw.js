@@ -22,20 +22,36 @@ self.addEventListener('activate', (event) => {
   self.clients.claim();
 });
 
+const isCachedApi = (url) => url.includes('/api/messages/') || url.includes('/api/contacts');
+
+// Revalidate cached API bodies with their ETag; a 304 is answered from the cache without a body transfer.
+async function revalidate(req) {
+  const cache = await caches.open(CACHE_NAME);
+  const cached = await cache.match(req);
+  const etag = cached && cached.headers.get('ETag');
+  const headers = new Headers(req.headers);
+  if (etag) headers.set('If-None-Match', etag);
+  const res = await fetch(req.url, { headers, credentials: 'same-origin', cache: 'no-store' });
+  if (res.status === 304 && cached) return cached;
+  if (res.ok) cache.put(req, res.clone());
+  return res;
+}
+
 self.addEventListener('fetch', (event) => {
   const req = event.request;
   if (req.method !== 'GET') return;
+  // Media is immutable and often fetched by byte range; leave it to the browser's HTTP cache.
+  if (new URL(req.url).pathname.startsWith('/media/')) return;
+
+  if (isCachedApi(req.url)) {
+    event.respondWith(
+      revalidate(req).catch(() => caches.match(req).then((cached) => cached || caches.match('/chat')))
+    );
+    return;
+  }
 
   event.respondWith(
-    fetch(req)
-      .then((res) => {
-        if (req.url.includes('/api/messages/') || req.url.includes('/api/contacts')) {
-          const copy = res.clone();
-          caches.open(CACHE_NAME).then((cache) => cache.put(req, copy));
-        }
-        return res;
-      })
-      .catch(() => caches.match(req).then((cached) => cached || caches.match('/chat')))
+    fetch(req).catch(() => caches.match(req).then((cached) => cached || caches.match('/chat')))
   );
 });
 